@@ -30,6 +30,10 @@ setup(name='tshistory_formula',
           'test-formula=tshistory_formula.cli:test_formula',
           'formula-init-db=tshistory_formula.cli:init_db',
           'migrate-to-formula-groups=tshistory_formula.cli:migrate_to_groups',
+          'migrate-to-formula-cache=tshistory_formula.cli:migrate_to_formula_cache',
+          'migrate-to-formula-dependencies=tshistory_formula.cli:migrate_to_formula_dependencies',
+          'migrate-to-materialized-formulas=tshistory_formula.cli:migrate_to_materialized_formulas',
+          'refresh-materialized-formulas=tshistory_formula.cli:refresh_materialized_formulas',
           'shell=tshistory_formula.cli:shell'
       ]},
       classifiers=[
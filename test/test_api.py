@@ -196,6 +196,133 @@ def test_formula_components(tsa):
     assert len(idates) == 3
 
 
+def test_dependents(tsa):
+    series = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(pd.Timestamp('2020-6-1'), freq='D', periods=3)
+    )
+    tsa.update('dep-a', series, 'Babar')
+    tsa.update('dep-b', series, 'Babar')
+
+    tsa.register_formula(
+        'dep-a-plus-b',
+        '(add (series "dep-a") (series "dep-b"))'
+    )
+    tsa.register_formula(
+        'dep-twice',
+        '(* 2 (series "dep-a-plus-b"))'
+    )
+    tsa.register_formula(
+        'dep-mixed',
+        '(add (series "dep-twice") (series "dep-b" #:fill 0))'
+    )
+
+    assert tsa.dependents('dep-a') == [
+        'dep-a-plus-b', 'dep-mixed', 'dep-twice'
+    ]
+    assert tsa.dependents('dep-a', transitive=False) == ['dep-a-plus-b']
+    assert tsa.dependents('dep-b', transitive=False) == [
+        'dep-a-plus-b', 'dep-mixed'
+    ]
+    assert tsa.dependents('dep-mixed') == []
+
+    tsa.delete('dep-twice')
+    assert tsa.dependents('dep-a') == ['dep-a-plus-b']
+
+
+def test_iterhistory(tsa):
+    for day in (1, 2, 3):
+        series = pd.Series(
+            [day] * 3,
+            index=pd.date_range(pd.Timestamp('2020-6-1'), freq='D', periods=3 + day)[day:]
+        )
+        tsa.update('iter-a', series, 'Babar',
+                   insertion_date=utcdt(2020, 6, day))
+        tsa.update('iter-b', series * 2, 'Babar',
+                   insertion_date=utcdt(2020, 6, day, 12))
+
+    rtsh = timeseries('test-mapi-2')
+    rtsh.update(
+        tsa.engine,
+        pd.Series([1.], index=[pd.Timestamp('2020-6-1')]),
+        'iter-remote',
+        'Babar',
+        insertion_date=utcdt(2020, 6, 1)
+    )
+
+    tsa.register_formula(
+        'iter-formula',
+        '(add (series "iter-a") (series "iter-b" #:fill 0))'
+    )
+
+    versions = tsa.iterhistory('iter-formula')
+    assert not isinstance(versions, dict)
+    for name in ('iter-formula', 'iter-a', 'iter-remote'):
+        for diffmode in (False, True):
+            hist = tsa.history(name, diffmode=diffmode)
+            items = list(tsa.iterhistory(name, diffmode=diffmode))
+            assert [idate for idate, _ in items] == list(hist)
+            for idate, ts in items:
+                assert ts.equals(hist[idate])
+
+    items = list(tsa.iterhistory(
+        'iter-formula',
+        from_insertion_date=utcdt(2020, 6, 2),
+        to_value_date=pd.Timestamp('2020-6-4')
+    ))
+    hist = tsa.history(
+        'iter-formula',
+        from_insertion_date=utcdt(2020, 6, 2),
+        to_value_date=pd.Timestamp('2020-6-4')
+    )
+    assert [idate for idate, _ in items] == list(hist)
+    for idate, ts in items:
+        assert ts.equals(hist[idate])
+
+    assert list(tsa.iterhistory('no-such-series')) == []
+
+
+def test_staircases(tsa):
+    for day in (1, 2, 3):
+        series = pd.Series(
+            [float(day)] * 5,
+            index=pd.date_range(pd.Timestamp('2020-6-1'), freq='D', periods=5 + day)[day:]
+        )
+        tsa.update('stairs-a', series, 'Babar',
+                   insertion_date=utcdt(2020, 6, day))
+
+    rtsh = timeseries('test-mapi-2')
+    for day in (1, 2):
+        rtsh.update(
+            tsa.engine,
+            pd.Series([float(day)] * 3,
+                      index=pd.date_range(pd.Timestamp('2020-6-2'), freq='D', periods=3)),
+            'stairs-remote',
+            'Babar',
+            insertion_date=utcdt(2020, 6, day)
+        )
+
+    tsa.register_formula(
+        'stairs-formula',
+        '(* 2 (series "stairs-a"))'
+    )
+
+    deltas = [pd.Timedelta(hours=12), pd.Timedelta(days=1)]
+    for name in ('stairs-a', 'stairs-formula'):
+        df = tsa.staircases(name, deltas)
+        assert list(df.columns) == deltas
+        for delta in deltas:
+            assert df[delta].dropna().equals(tsa.staircase(name, delta))
+
+    df = tsa.staircases('stairs-remote', deltas)
+    for delta in deltas:
+        assert df[delta].dropna().equals(
+            rtsh.staircase(tsa.engine, 'stairs-remote', delta)
+        )
+
+    assert tsa.staircases('no-such-series', deltas) is None
+
+
 def test_formula_components_wall(tsa):
     series = pd.Series(
         [1, 2, 3],
@@ -1,9 +1,11 @@
 from datetime import datetime as dt, timedelta
+import threading
 
 import pandas as pd
 import numpy as np
 import pytest
 from decorator import decorate
+from sqlalchemy import create_engine
 
 from psyl import lisp
 from tshistory.testutil import (
@@ -12,6 +14,8 @@ from tshistory.testutil import (
     gengroup,
     utcdt
 )
+from tshistory.tsio import timeseries as basets
+from tshistory.util import diff
 
 from tshistory_formula.registry import (
     func,
@@ -19,6 +23,7 @@ from tshistory_formula.registry import (
     finder,
     HISTORY,
     history,
+    lazyhistory,
     metadata
 )
 from tshistory_formula.helper import (
@@ -26,9 +31,18 @@ from tshistory_formula.helper import (
     _extract_from_expr,
     expanded,
     _name_from_signature_and_args,
-    name_of_expr
+    name_of_expr,
+    SnapshotConnections,
+    WorkerPool
 )
+from tshistory_formula.evaluator import (
+    pcompile,
+    pevaluate
+)
+from tshistory_formula.tsio import diff_versions
 from tshistory_formula.interpreter import (
+    has_compatible_operators,
+    HistoryInterpreter,
     Interpreter,
     NullIntepreter,
     OperatorHistory
@@ -57,6 +71,219 @@ def test_evaluator():
     assert tree == ['+', 20.0, ['series', 'foo']]
 
 
+def test_plan():
+    tree = lisp.parse(
+        '(add (scale (series "a" #:fill 0) #:by 2) (series "b") #t)'
+    )
+    plan = pcompile(tree)
+    # the auto operators come first
+    assert [step.op for step in plan.steps] == [
+        'series', 'series', 'scale', 'add'
+    ]
+    first = plan.steps[0]
+    assert first.args == ['a']
+    assert first.kwargs == {'fill': 0}
+    assert plan.steps[2].argslots == [(0, 0)]
+    assert plan.steps[3].args == [None, None, True]
+    assert plan.steps[3].argslots == [(0, 2), (1, 1)]
+
+    env = lisp.Env({
+        'series': lambda name, fill=None: {'a': 1, 'b': 10}[name],
+        'scale': lambda x, by: x * by,
+        'add': lambda *a: sum(a)
+    })
+    assert pevaluate(plan, env) == 13
+    # plans are reusable
+    assert pevaluate(plan, env) == 13
+
+    # common subexpressions are evaluated once
+    tree = lisp.parse(
+        '(add (scale (series "a") #:by 2) (series "a") (series "a" #:fill 0))'
+    )
+    plan = pcompile(tree)
+    assert [step.op for step in plan.steps] == [
+        'series', 'series', 'scale', 'add'
+    ]
+    assert plan.steps[3].argslots == [(0, 2), (1, 0), (2, 1)]
+
+
+def test_worker_pool():
+    pool = WorkerPool(2)
+    gate = threading.Event()
+    running = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+    lock = threading.Lock()
+
+    def work(sid, wait):
+        with lock:
+            running[sid] += 1
+            peak[sid] = max(peak[sid], running[sid])
+        if wait:
+            gate.wait(5)
+        with lock:
+            running[sid] -= 1
+        return sid
+
+    with pool.session(1) as a:
+        afutures = [a.submit(work, 'a', True) for _ in range(3)]
+        # a is held at its limit: b gets the other worker
+        with pool.session(2) as b:
+            assert b.submit(work, 'b', False).result(timeout=5) == 'b'
+        assert not any(f.done() for f in afutures)
+        gate.set()
+    assert all(f.result() == 'a' for f in afutures)
+    assert peak == {'a': 1, 'b': 1}
+    assert len(pool._threads) == 2
+
+    # nested submissions from a worker run in place
+    with pool.session(1) as s:
+        outer = s.submit(
+            lambda: s.submit(threading.current_thread).result()
+        )
+        assert outer.result(timeout=5).name.startswith('formula-worker')
+
+
+def test_snapshot_connections(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'snap-a', 'Babar')
+    tsh.update(engine, ts, 'snap-b', 'Babar')
+    tsh.register_formula(
+        engine,
+        'snap-sum',
+        '(add (series "snap-a") (series "snap-b"))'
+    )
+
+    connect = SnapshotConnections._connect
+    snapshots = []
+
+    def _connect(self):
+        if not snapshots:
+            # a concurrent writer commits once the request has started
+            tsh.update(engine, ts + 10, 'snap-a', 'Celeste')
+        snapshots.append(self.snapshot)
+        return connect(self)
+
+    monkeypatch.setattr(SnapshotConnections, '_connect', _connect)
+    monkeypatch.setattr(Interpreter, 'prefetching', False)
+
+    with engine.begin() as cn:
+        assert tsh.get(cn, 'snap-sum').tolist() == [2., 4., 6.]
+    assert len(snapshots) and len(set(snapshots)) == 1
+
+    assert tsh.get(engine, 'snap-sum').tolist() == [12., 14., 16.]
+
+    # the request own writes must be seen: no snapshot
+    snapshots.clear()
+    with engine.begin() as cn:
+        tsh.update(cn, ts + 20, 'snap-b', 'Babar')
+        assert tsh.get(cn, 'snap-sum').tolist() == [32., 34., 36.]
+    assert snapshots == []
+
+
+def test_snapshot_connections_savepoint(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'snap-nested-a', 'Babar')
+    tsh.update(engine, ts, 'snap-nested-b', 'Babar')
+    tsh.register_formula(
+        engine,
+        'snap-nested-sum',
+        '(add (series "snap-nested-a") (series "snap-nested-b"))'
+    )
+    monkeypatch.setattr(Interpreter, 'prefetching', False)
+
+    # no snapshot export from a subtransaction
+    with engine.begin() as cn:
+        with cn.begin_nested():
+            assert tsh.get(cn, 'snap-nested-sum').tolist() == [2., 4., 6.]
+
+
+def test_snapshot_connections_exhausted_pool(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'snap-pool-a', 'Babar')
+    tsh.update(engine, ts, 'snap-pool-b', 'Babar')
+    tsh.register_formula(
+        engine,
+        'snap-pool-sum',
+        '(add (series "snap-pool-a") (series "snap-pool-b"))'
+    )
+    monkeypatch.setattr(Interpreter, 'prefetching', False)
+
+    small = create_engine(
+        str(engine.url), pool_size=2, max_overflow=0, pool_timeout=2
+    )
+    barrier = threading.Barrier(2)
+    results = []
+
+    def request():
+        with small.begin() as cn:
+            # both requests hold a connection: the pool is exhausted
+            barrier.wait(5)
+            results.append(tsh.get(cn, 'snap-pool-sum').tolist())
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    small.dispose()
+
+    assert results == [[2., 4., 6.]] * 2
+
+
+def test_get_many(engine, tsh):
+    for idx, idate in enumerate(pd.date_range(utcdt(2022, 1, 1), periods=3)):
+        ts = pd.Series(
+            [idx] * 5 + [np.nan],
+            index=pd.date_range(utcdt(2022, 1, idx + 1), periods=6, freq='D')
+        )
+        tsh.update(engine, ts, 'many-tz', 'Babar', insertion_date=idate)
+        tsh.update(engine, ts.tz_localize(None), 'many-naive', 'Babar',
+                   insertion_date=idate)
+    tsh.register_formula(
+        engine,
+        'many-formula',
+        '(add (series "many-tz") (series "many-tz" #:fill 0))'
+    )
+
+    names = ['many-tz', 'many-naive', 'many-formula', 'many-unknown']
+    for kw in (
+            {},
+            {'revision_date': utcdt(2022, 1, 2)},
+            {'revision_date': utcdt(2021, 1, 1)},
+            {'from_value_date': utcdt(2022, 1, 3),
+             'to_value_date': utcdt(2022, 1, 5)},
+            {'revision_date': utcdt(2022, 1, 2),
+             'from_value_date': utcdt(2022, 1, 6)}
+    ):
+        series = tsh._get_many(engine, names, **kw)
+        # the formulas and unknown names are left to .get
+        assert series.keys() == set(names[:2])
+        for name in names[:2]:
+            expected = tsh.get(engine, name, **kw)
+            assert series[name].equals(expected), (name, kw)
+            assert series[name].name == name
+
+    # the prefetch leaves the non primary leaves to the worker pool
+    i = Interpreter(engine, tsh, {})
+    plan = pcompile(
+        lisp.parse(
+            '(add (series "many-tz") (series "many-tz" #:fill 0)'
+            '     (series "many-formula") (series "many-unknown"))'
+        )
+    )
+    assert i.prefetch(plan) == 2
+    assert i.prefetched[1].keys() == {'many-tz'}
+
+
 def test_bad_toplevel_type(engine, tsh):
     msg = 'formula `test_bad_toplevel_type` must return a `Series`, not `int`'
     with pytest.raises(TypeError, match=msg):
@@ -621,6 +848,49 @@ insertion_date             value_date
 """, h)
 
 
+def test_insertion_dates_nested(engine, tsh):
+    for idx, name in enumerate(('idates-a', 'idates-b', 'idates-c')):
+        for day in (1, 2, 3):
+            tsh.update(
+                engine,
+                pd.Series([float(day)], index=[dt(2021, 1, day)]),
+                name, 'Babar',
+                insertion_date=utcdt(2020, 1, day, idx)
+            )
+    tsh.register_formula(
+        engine, 'idates-shared', '(add (series "idates-a") (series "idates-b"))'
+    )
+    tsh.register_formula(
+        engine, 'idates-left', '(* 2 (series "idates-shared"))'
+    )
+    tsh.register_formula(
+        engine,
+        'idates-top',
+        '(add (series "idates-left") (series "idates-shared") (series "idates-c"))'
+    )
+
+    for fromdate, todate in ((None, None),
+                             (utcdt(2020, 1, 1, 2), None),
+                             (None, utcdt(2020, 1, 2, 1)),
+                             (utcdt(2020, 1, 2), utcdt(2020, 1, 3))):
+        expected = sorted(
+            idate
+            for name in ('idates-a', 'idates-b', 'idates-c')
+            for idate in tsh.insertion_dates(
+                engine, name, fromdate=fromdate, todate=todate
+            )
+        )
+        assert tsh.insertion_dates(
+            engine, 'idates-top', fromdate=fromdate, todate=todate
+        ) == expected
+        assert tsh.insertion_dates(
+            engine, 'idates-shared', fromdate=fromdate, todate=todate
+        ) == [
+            idate for idate in expected
+            if idate.hour in (0, 1)
+        ]
+
+
 def test_history_bounds(engine, tsh):
     # two series, one with a gap
 
@@ -692,6 +962,41 @@ insertion_date             value_date
 """, hist_top)
 
 
+def test_history_first_idate_batch(engine, tsh, monkeypatch):
+    for idx in range(5):
+        for day in (1, 2, 3):
+            # shifted versions: none of them is complete at the
+            # lower insertion date bound
+            tsh.update(
+                engine,
+                pd.Series([float(idx + day)], index=[dt(2021, 4, day)]),
+                f'batch-{idx}', 'Babar',
+                insertion_date=utcdt(2020, 1, day, idx)
+            )
+    tsh.register_formula(
+        engine,
+        'sum-batch',
+        '(add {})'.format(
+            ' '.join(f'(series "batch-{idx}" #:fill 0)' for idx in range(5))
+        )
+    )
+    expected = tsh.history(engine, 'sum-batch')
+
+    gets = []
+    get = tsh.get
+    def counting_get(cn, name, **kw):
+        gets.append(name)
+        return get(cn, name, **kw)
+    monkeypatch.setattr(tsh, 'get', counting_get)
+
+    fromdate = utcdt(2020, 1, 2, 2)
+    hist = tsh.history(engine, 'sum-batch', from_insertion_date=fromdate)
+    assert gets == []
+    assert list(hist) == [idate for idate in expected if idate >= fromdate]
+    for idate, ts in hist.items():
+        assert ts.equals(expected[idate])
+
+
 def test_history_diffmode(engine, tsh):
     for i in range(1, 4):
         ts = pd.Series([i], index=[utcdt(2020, 1, i)])
@@ -712,6 +1017,194 @@ insertion_date             value_date
 """, h)
 
 
+def test_history_incremental(engine, tsh, monkeypatch):
+    base = pd.Series(
+        range(10),
+        index=pd.date_range(utcdt(2020, 1, 1), periods=10, freq='D'),
+        dtype='float64'
+    )
+    tsh.update(engine, base, 'incr-a', 'Babar',
+               insertion_date=utcdt(2020, 1, 1))
+    tsh.update(engine, base * 10, 'incr-b', 'Babar',
+               insertion_date=utcdt(2020, 1, 2))
+    # point changes
+    tsh.update(engine, base[2:4] + .5, 'incr-a', 'Babar',
+               insertion_date=utcdt(2020, 1, 3))
+    # point erasure
+    erase = base[5:6].copy()
+    erase[:] = np.nan
+    tsh.update(engine, erase, 'incr-b', 'Babar',
+               insertion_date=utcdt(2020, 1, 4))
+    # new points, at the same idate for both
+    new = pd.Series(
+        [1., 2.],
+        index=pd.date_range(utcdt(2020, 1, 11), periods=2, freq='D')
+    )
+    tsh.update(engine, new, 'incr-a', 'Babar',
+               insertion_date=utcdt(2020, 1, 5))
+    tsh.update(engine, new * 2, 'incr-b', 'Babar',
+               insertion_date=utcdt(2020, 1, 5))
+    # no-op idate
+    tsh.update(engine, pd.Series([42.], index=[utcdt(2021, 1, 1)]),
+               'incr-c', 'Babar', insertion_date=utcdt(2020, 1, 6))
+
+    formulas = {
+        'incr-add': '(add (series "incr-a") (series "incr-b"))',
+        'incr-fill': '(add (series "incr-a" #:fill 0) (series "incr-b" #:fill 1))',
+        'incr-prio': '(priority (series "incr-b") (* 2 (series "incr-a")))',
+        'incr-clip': '(clip (mul (series "incr-a") (series "incr-b" #:fill 1)) '
+                     '#:max 40 #:replacemax #t)',
+        'incr-nop': '(add (series "incr-a" #:fill 0) (series "incr-c" #:fill 0))',
+        'incr-ffill': '(add (series "incr-a") (series "incr-b" #:fill "ffill"))'
+    }
+    for name, text in formulas.items():
+        tsh.register_formula(engine, name, text)
+
+    assert tsh._pointwise(tsh._expanded(engine, formulas['incr-clip']).plan)
+    assert not tsh._pointwise(tsh._expanded(engine, formulas['incr-ffill']).plan)
+
+    # the operators declare it at registration time
+    @func('incr-neg', pointwise=True)
+    def incr_neg(series: pd.Series) -> pd.Series:
+        return -series
+
+    @func('incr-opaque')
+    def incr_opaque(series: pd.Series) -> pd.Series:
+        return series
+
+    assert tsh._pointwise(pcompile(lisp.parse('(incr-neg (series "incr-a"))')))
+    assert not tsh._pointwise(pcompile(lisp.parse('(incr-opaque (series "incr-a"))')))
+    FUNCS.pop('incr-neg')
+    FUNCS.pop('incr-opaque')
+
+    incremental = {
+        name: tsh.history(engine, name)
+        for name in formulas
+    }
+    incrdiffs = {
+        name: [
+            tsh.history(engine, name, diffmode=True),
+            tsh.history(engine, name, diffmode=True,
+                        from_insertion_date=utcdt(2020, 1, 3))
+        ]
+        for name in formulas
+    }
+    monkeypatch.setattr(tsh, '_pointwise', lambda plan: False)
+    for name in formulas:
+        full = tsh.history(engine, name)
+        assert full.keys() == incremental[name].keys()
+        for idate, ts in full.items():
+            assert ts.equals(incremental[name][idate]), (name, idate)
+            assert incremental[name][idate].name == name
+
+        # diffmode, against the pairwise diffs of the full versions
+        for incrdiff, fromdate in zip(incrdiffs[name], (None, utcdt(2020, 1, 3))):
+            versions = {
+                idate: ts for idate, ts in full.items()
+                if fromdate is None or idate >= fromdate
+            }
+            basets = None
+            if fromdate is not None:
+                basets = tsh.get(engine, name,
+                                 revision_date=fromdate - timedelta(seconds=1))
+            assert incrdiff.keys() == versions.keys()
+            assert tsh.history(engine, name, diffmode=True,
+                               from_insertion_date=fromdate).keys() == versions.keys()
+            for idate, ts in versions.items():
+                expected = diff(basets, ts)
+                assert incrdiff[idate].equals(expected), (name, idate)
+                basets = ts
+
+
+def test_diff_versions():
+    index = pd.date_range(utcdt(2020, 1, 1), periods=6, freq='D')
+    base = pd.Series([1, 2, np.nan, 4, 5, 6], index=index, dtype='float64')
+    other = pd.Series(
+        [1, 2.5, 3, np.nan, 5, 7, np.nan, 8],
+        index=index.append(
+            pd.date_range(utcdt(2020, 1, 7), periods=2, freq='D')
+        ),
+        dtype='float64'
+    )
+    for b, o in ((base, other), (other, base), (None, other),
+                 (base.iloc[:0], other), (base, base.iloc[:0]),
+                 (other, other + 1e-15)):
+        assert diff_versions(b, o).equals(diff(b, o))
+
+    strings = pd.Series(['a', 'b', 'c'], index=index[:3])
+    assert diff_versions(
+        strings, strings.replace('b', 'B')
+    ).equals(diff(strings, strings.replace('b', 'B')))
+
+
+def test_history_parallel(engine, tsh, monkeypatch):
+    for day in range(1, 13):
+        ts = pd.Series(
+            [float(day)] * 3,
+            index=pd.date_range(utcdt(2020, 1, day), periods=3, freq='D')
+        )
+        tsh.update(engine, ts, 'par-a', 'Babar',
+                   insertion_date=utcdt(2020, 1, day, 1))
+        if day % 3 == 0:
+            tsh.update(engine, ts * 2, 'par-b', 'Babar',
+                       insertion_date=utcdt(2020, 1, day, 2))
+
+    formulas = {
+        'par-add': '(add (series "par-a") (series "par-b" #:fill 0))',
+        'par-ffill': '(add (series "par-a") (series "par-b" #:fill "ffill"))'
+    }
+    for name, text in formulas.items():
+        tsh.register_formula(engine, name, text)
+
+    sequential = {
+        name: tsh.history(engine, name)
+        for name in formulas
+    }
+    monkeypatch.setattr(tsh, 'history_workers', 4)
+    for name in formulas:
+        # from an engine, and from a transaction (exported snapshot)
+        with engine.connect() as cn:
+            with cn.begin():
+                histories = [
+                    tsh.history(engine, name),
+                    tsh.history(cn, name)
+                ]
+        for parallel in histories:
+            assert list(parallel) == list(sequential[name])
+            for idate, ts in sequential[name].items():
+                assert ts.equals(parallel[idate]), (name, idate)
+                assert parallel[idate].name == name
+
+
+def test_history_nearest_idate(engine, tsh):
+    tsh.update(engine, pd.Series([1.], index=[utcdt(2020, 1, 1)]),
+               'nearest-a', 'Babar', insertion_date=utcdt(2020, 1, 1))
+    idates = [utcdt(2020, 1, day) for day in range(1, 20, 2)]
+    hist = {
+        idate: pd.Series([float(idx)], index=[idate])
+        for idx, idate in enumerate(idates)
+    }
+    i = HistoryInterpreter(
+        'nearest-a', engine, tsh, {}, histories={'nearest-a': hist}
+    )
+
+    assert not len(i._find_by_nearest_idate('nearest-a', utcdt(2019, 1, 1)))
+    # in order, as the history loop does
+    for day in range(1, 22):
+        ts = i._find_by_nearest_idate('nearest-a', utcdt(2020, 1, day))
+        assert ts.iloc[0] == min((day - 1) // 2, 9)
+    # backwards and naive
+    for day in range(21, 0, -1):
+        ts = i._find_by_nearest_idate('nearest-a', dt(2020, 1, day))
+        assert ts.iloc[0] == min((day - 1) // 2, 9)
+
+    # the histories can be swapped
+    i.histories['nearest-a'] = {idates[0]: hist[idates[0]]}
+    assert i._find_by_nearest_idate(
+        'nearest-a', utcdt(2020, 1, 19)
+    ).iloc[0] == 0
+
+
 def test_staircase(engine, tsh):
     tsh.register_formula(
         engine,
@@ -781,6 +1274,171 @@ def test_staircase(engine, tsh):
     FUNCS.pop('identity')
 
 
+def test_staircase_pointwise_operators(engine, tsh):
+    for day in (1, 2, 3, 4, 5):
+        idate = utcdt(2018, 1, day)
+        for idx, name in enumerate(('sp-a', 'sp-b')):
+            ts = pd.Series(
+                [day + idx + 1.] * 5,
+                index=pd.date_range(dt(2018, 1, day), periods=5, freq='D')
+            )
+            tsh.update(engine, ts, name, 'Babar',
+                       insertion_date=idate)
+
+    formulas = {
+        'sp-mul': '(mul (series "sp-a") (series "sp-b"))',
+        'sp-div': '(/ (div (series "sp-a") (series "sp-b")) 2)',
+        'sp-clip': '(clip (series "sp-a") #:max 3 #:replacemax #t)',
+        'sp-slice': '(slice (series "sp-a") #:fromdate (date "2018-1-4"))',
+        'sp-stats': '(add (row-mean (series "sp-a") (series "sp-b")) '
+                    '     (min (series "sp-a") (series "sp-b")) '
+                    '     (max (series "sp-a") (series "sp-b")))',
+        'sp-nested': '(mul (series "sp-mul") (series "sp-clip"))'
+    }
+    for name, text in formulas.items():
+        tsh.register_formula(engine, name, text)
+
+    delta = pd.Timedelta(hours=12)
+    for name, text in formulas.items():
+        assert has_compatible_operators(
+            engine, tsh, lisp.parse(text), tsh.fast_staircase_operators
+        )
+        fast = tsh.staircase(engine, name, delta=delta)
+        slow = basets.staircase(tsh, engine, name, delta=delta)
+        assert fast.equals(slow), name
+
+    @func('sp-opaque')
+    def opaque(series: pd.Series) -> pd.Series:
+        return series
+
+    @func('sp-opted', staircase=True)
+    def opted(series: pd.Series) -> pd.Series:
+        return series
+
+    assert not has_compatible_operators(
+        engine, tsh, lisp.parse('(sp-opaque (series "sp-a"))'),
+        tsh.fast_staircase_operators
+    )
+    assert has_compatible_operators(
+        engine, tsh, lisp.parse('(sp-opted (series "sp-a"))'),
+        tsh.fast_staircase_operators
+    )
+    # at any depth
+    assert not has_compatible_operators(
+        engine, tsh,
+        lisp.parse('(add (series "sp-a") (+ 1 (sp-opaque (series "sp-b"))))'),
+        tsh.fast_staircase_operators
+    )
+
+    # through the formula dependencies
+    tsh.register_formula(engine, 'sp-inner', '(+ 1 (series "sp-b"))')
+    deep = '(add (series "sp-a") (series "sp-inner"))'
+    assert tsh._fast_staircase(engine, deep)
+    tsh.register_formula(
+        engine, 'sp-inner', '(+ 1 (sp-opaque (series "sp-b")))', update=True
+    )
+    assert not tsh._fast_staircase(engine, deep)
+
+    # a dropping clip filters on the values: no fast path
+    tsh.update(
+        engine,
+        pd.Series([1.], index=[dt(2020, 1, 5)]),
+        'sp-drop', 'Babar',
+        insertion_date=utcdt(2020, 1, 1)
+    )
+    tsh.update(
+        engine,
+        pd.Series([10.], index=[dt(2020, 1, 5)]),
+        'sp-drop', 'Babar',
+        insertion_date=utcdt(2020, 1, 4, 12)
+    )
+    tsh.register_formula(
+        engine,
+        'sp-clip-drop',
+        '(clip (series "sp-drop") #:max 5)'
+    )
+    assert not tsh._fast_staircase(engine, '(clip (series "sp-drop") #:max 5)')
+    assert tsh._fast_staircase(
+        engine, '(clip (series "sp-drop") #:max 5 #:replacemax #t)'
+    )
+    assert not tsh._fast_staircase(
+        engine,
+        '(clip (series "sp-drop") #:min 0 #:max 5 #:replacemax #t)'
+    )
+    delta = pd.Timedelta(days=1)
+    fast = tsh.staircase(engine, 'sp-clip-drop', delta=delta)
+    slow = basets.staircase(tsh, engine, 'sp-clip-drop', delta=delta)
+    assert fast.equals(slow)
+    assert len(fast) == 0
+
+    # cleanup
+    FUNCS.pop('sp-opaque')
+    FUNCS.pop('sp-opted')
+
+
+def test_staircases(engine, tsh, monkeypatch):
+    for day in range(1, 6):
+        for hour in (0, 12, 18):
+            idate = utcdt(2018, 1, day, hour)
+            for idx, name in enumerate(('scs-a', 'scs-b')):
+                ts = pd.Series(
+                    [day * 10 + hour / 6. + idx] * 48,
+                    index=pd.date_range(
+                        dt(2018, 1, day, hour), periods=48, freq='H'
+                    )
+                )
+                if hour == 12 and idx:
+                    # erased points
+                    ts.iloc[5:10] = np.nan
+                tsh.update(engine, ts, name, 'Babar',
+                           insertion_date=idate)
+
+    @func('scs-opaque')
+    def opaque(series: pd.Series) -> pd.Series:
+        return series
+
+    tsh.register_formula(
+        engine, 'scs-fast', '(add (series "scs-a") (* 2 (series "scs-b")))'
+    )
+    tsh.register_formula(
+        engine, 'scs-nested', '(mul (series "scs-fast") (series "scs-b"))'
+    )
+    tsh.register_formula(
+        engine, 'scs-slow', '(scs-opaque (series "scs-a"))'
+    )
+
+    deltas = [pd.Timedelta(hours=h) for h in (0, 5, 13, 30, 60)]
+    for name in ('scs-a', 'scs-b', 'scs-fast', 'scs-nested', 'scs-slow'):
+        for bounds in ({},
+                       {'from_value_date': dt(2018, 1, 3),
+                        'to_value_date': dt(2018, 1, 5, 12)}):
+            df = tsh.staircases(engine, name, deltas, **bounds)
+            assert list(df.columns) == deltas
+            for delta in deltas:
+                expected = tsh.staircase(engine, name, delta, **bounds)
+                assert df[delta].dropna().equals(expected), (name, delta)
+
+    # the leaves histories are read once
+    histories = []
+    history = tsh.history
+    def counting_history(cn, name, **kw):
+        histories.append(name)
+        return history(cn, name, **kw)
+    monkeypatch.setattr(tsh, 'history', counting_history)
+    tsh.staircases(engine, 'scs-nested', deltas)
+    assert sorted(histories) == ['scs-a', 'scs-b']
+
+    assert tsh.staircases(engine, 'no-such-series', deltas) is None
+
+    # no delta
+    for name in ('scs-a', 'scs-nested', 'no-such-series'):
+        with pytest.raises(ValueError, match='at least one delta'):
+            tsh.staircases(engine, name, [])
+
+    # cleanup
+    FUNCS.pop('scs-opaque')
+
+
 def test_new_func(engine, tsh):
 
     @func('identity')
@@ -1036,6 +1694,250 @@ def test_rename(engine, tsh):
         engine, 'survive-renaming-2'
     ) == '(add (series "survived") (series "a-renamed" #:fill 0))'
 
+    # the dependency index followed
+    assert tsh.dependencies(engine, 'survive-renaming-2') == {
+        'survive-renaming-2': [
+            ('survived', 'formula'),
+            ('a-renamed', 'primary')
+        ]
+    }
+    assert tsh.dependencies(
+        engine, 'survive-renaming-2', transitive=True
+    ) == {
+        'survive-renaming-2': [
+            ('survived', 'formula'),
+            ('a-renamed', 'primary')
+        ],
+        'survived': [
+            ('a-renamed', 'primary')
+        ]
+    }
+    with engine.begin() as cn:
+        assert cn.execute(
+            f'select kind, ref from "{tsh.namespace}".formula_dependency '
+            'where name = %(name)s order by id',
+            name='survived'
+        ).fetchall() == [
+            ('series', 'a-renamed'),
+            ('operator', '+'),
+            ('operator', 'series')
+        ]
+
+    tsh.delete(engine, 'survived')
+    assert tsh.dependencies(engine, 'survived') == {}
+
+
+def test_materialized(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'mat-a', 'Babar',
+               insertion_date=utcdt(2022, 1, 1))
+    tsh.update(engine, ts, 'mat-b', 'Babar',
+               insertion_date=utcdt(2022, 1, 1))
+    tsh.register_formula(
+        engine,
+        'mat-sum',
+        '(add (series "mat-a") (series "mat-b"))'
+    )
+    tsh.register_formula(
+        engine,
+        'mat-top',
+        '(* 2 (series "mat-sum"))'
+    )
+
+    with pytest.raises(ValueError):
+        tsh.materialize(engine, 'mat-a')
+    tsh.materialize(engine, 'mat-top')
+
+    evaluations = []
+    eval_formula = tsh.eval_formula
+
+    def counting(cn, formula, **kw):
+        evaluations.append(formula)
+        return eval_formula(cn, formula, **kw)
+
+    monkeypatch.setattr(tsh, 'eval_formula', counting)
+
+    assert tsh.get(engine, 'mat-top').tolist() == [4., 8., 12.]
+    assert len(evaluations) == 1
+    ts2 = tsh.get(engine, 'mat-top')
+    assert ts2.tolist() == [4., 8., 12.]
+    assert ts2.name == 'mat-top'
+    assert tsh.get(
+        engine, 'mat-top', from_value_date=utcdt(2022, 1, 2)
+    ).tolist() == [8., 12.]
+    assert len(evaluations) == 1
+
+    # an update of a (transitive) component makes it stale
+    tsh.update(engine, ts + 1, 'mat-a', 'Babar',
+               insertion_date=utcdt(2022, 1, 2))
+    assert tsh.get(engine, 'mat-top').tolist() == [6., 10., 14.]
+    assert len(evaluations) == 2
+
+    # a no-op update does not
+    tsh.update(engine, ts + 1, 'mat-a', 'Babar',
+               insertion_date=utcdt(2022, 1, 3))
+    tsh.get(engine, 'mat-top')
+    assert len(evaluations) == 2
+
+    # the past is computed
+    assert tsh.get(
+        engine, 'mat-top', revision_date=utcdt(2022, 1, 1)
+    ).tolist() == [4., 8., 12.]
+    assert len(evaluations) == 3
+
+    # formula update
+    tsh.register_formula(
+        engine,
+        'mat-sum',
+        '(add (series "mat-a") (series "mat-b") (series "mat-b"))',
+        update=True
+    )
+    assert tsh.refresh_materialized(engine) == ['mat-top']
+    assert len(evaluations) == 4
+    assert tsh.get(engine, 'mat-top').tolist() == [8., 14., 20.]
+    assert len(evaluations) == 4
+
+    tsh.materialize(engine, 'mat-top', False)
+    tsh.get(engine, 'mat-top')
+    assert len(evaluations) == 5
+
+
+def test_materialized_strip(engine, tsh):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'mat-strip', 'Babar',
+               insertion_date=utcdt(2022, 1, 1))
+    tsh.update(engine, ts + 1, 'mat-strip', 'Babar',
+               insertion_date=utcdt(2022, 1, 2))
+    tsh.register_formula(
+        engine,
+        'mat-strip-top',
+        '(* 2 (series "mat-strip"))'
+    )
+    tsh.materialize(engine, 'mat-strip-top')
+    assert tsh.get(engine, 'mat-strip-top').tolist() == [4., 6., 8.]
+
+    csid = tsh.changeset_at(engine, 'mat-strip', utcdt(2022, 1, 2))
+    tsh.strip(engine, 'mat-strip', csid)
+    assert tsh.get(engine, 'mat-strip-top').tolist() == [2., 4., 6.]
+
+
+def test_materialized_volatile(engine, tsh):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'mat-volatile', 'Babar')
+
+    @func('mat-auto', auto=True)
+    def mat_auto(__interpreter__) -> pd.Series:
+        return ts
+
+    @finder('mat-auto')
+    def mat_auto_finder(cn, tsh, tree):
+        return {tree[0]: tree}
+
+    formulas = {
+        'mat-with-auto': '(add (series "mat-volatile") (mat-auto))',
+        'mat-with-today': (
+            '(slice (series "mat-volatile") #:fromdate (today))'
+        ),
+        'mat-with-remote': '(+ 1 (series "mat-elsewhere"))'
+    }
+    for name, text in formulas.items():
+        tsh.register_formula(engine, name, text, False)
+    tsh.register_formula(
+        engine,
+        'mat-over-auto',
+        '(* 2 (series "mat-with-auto"))'
+    )
+
+    for name, culprit in (
+            ('mat-with-auto', '`mat-auto`'),
+            ('mat-over-auto', '`mat-auto`'),
+            ('mat-with-today', '`today`'),
+            ('mat-with-remote', '`mat-elsewhere` is not a local series')
+    ):
+        with pytest.raises(ValueError) as err:
+            tsh.materialize(engine, name)
+        assert culprit in str(err.value)
+        assert not tsh._is_materialized(engine, name)
+
+    FUNCS.pop('mat-auto')
+
+
+def test_formula_cache(engine, tsh):
+    tsh.register_formula(
+        engine,
+        'cached-formula',
+        '(+ 1 (series "cache-a"))',
+        False
+    )
+    assert tsh.formula(engine, 'cached-formula') == '(+ 1 (series "cache-a"))'
+    assert tsh.type(engine, 'cached-formula') == 'formula'
+
+    # another process changes the formula
+    with engine.begin() as cn:
+        cn.execute(
+            f'update "{tsh.namespace}".formula '
+            'set text = \'(+ 2 (series "cache-a"))\' '
+            'where name = \'cached-formula\''
+        )
+        cn.execute(
+            f'update "{tsh.namespace}".formula_version '
+            'set version = version + 1'
+        )
+
+    # we did not look at the version counter yet
+    assert tsh.formula(engine, 'cached-formula') == '(+ 1 (series "cache-a"))'
+
+    tsh.formula_cache_ttl = 0
+    try:
+        assert tsh.formula(engine, 'cached-formula') == '(+ 2 (series "cache-a"))'
+    finally:
+        del tsh.formula_cache_ttl
+
+    # uncommitted changes are not leaked
+    with engine.connect() as cn:
+        tx = cn.begin()
+        tsh.register_formula(
+            cn,
+            'cached-formula-2',
+            '(+ 3 (series "cache-a"))',
+            False
+        )
+        assert tsh.formula(cn, 'cached-formula-2') == '(+ 3 (series "cache-a"))'
+        assert tsh.formula(engine, 'cached-formula-2') is None
+        tx.rollback()
+
+    assert tsh.formula(engine, 'cached-formula-2') is None
+
+    # another connection reads while we write: our changes are seen
+    # as soon as they are committed
+    tsh.formula_cache_ttl = 3600
+    try:
+        with engine.begin() as cn:
+            tsh.register_formula(
+                cn,
+                'cached-formula-3',
+                '(+ 4 (series "cache-a"))',
+                False
+            )
+            assert not tsh.exists(engine, 'cached-formula-3')
+        assert tsh.exists(engine, 'cached-formula-3')
+        assert tsh.formula(engine, 'cached-formula-3') == '(+ 4 (series "cache-a"))'
+    finally:
+        del tsh.formula_cache_ttl
+
+    tsh.delete(engine, 'cached-formula')
+    assert tsh.formula(engine, 'cached-formula') is None
+    assert not tsh.exists(engine, 'cached-formula')
+
 
 def test_unknown_operator(engine, tsh):
     with pytest.raises(ValueError) as err:
@@ -1180,6 +2082,76 @@ insertion_date             value_date
 """, hist)
 
 
+def test_lazy_history(engine, tsh, monkeypatch):
+    computed = []
+    histcalls = []
+
+    def version(idate):
+        computed.append(idate)
+        return pd.Series(
+            [float(idate.day)] * 2,
+            index=pd.date_range(dt(2019, 1, idate.day), periods=2, freq='D')
+        )
+
+    @func('lazy-series', auto=True)
+    def lazy(__interpreter__) -> pd.Series:
+        return version(utcdt(2020, 1, 3))
+
+    @metadata('lazy-series')
+    def lazy_metadata(_cn, _tsh, tree):
+        return {
+            tree[0]: {
+                'index_type': 'datetime64[ns]',
+                'index_dtype': '|M8[ns]',
+                'tzaware': False,
+                'value_type': 'float64',
+                'value_dtype': '<f8'
+            }
+        }
+
+    @history('lazy-series')
+    def lazy_history(__interpreter__):
+        histcalls.append(1)
+        return lazyhistory(
+            [utcdt(2020, 1, day) for day in (1, 2, 3)],
+            version
+        )
+
+    OperatorHistory.FUNCS = None
+    monkeypatch.setattr(tsh, 'auto_idates_ttl', 60)
+
+    tsh.register_formula(
+        engine,
+        'lazy-formula',
+        '(+ 1 (lazy-series))'
+    )
+
+    idates = [utcdt(2020, 1, day) for day in (1, 2, 3)]
+    assert tsh.insertion_dates(engine, 'lazy-formula') == idates
+    assert computed == []
+    assert len(histcalls) == 1
+
+    # served from the cache
+    assert tsh.insertion_dates(engine, 'lazy-formula') == idates
+    assert len(histcalls) == 1
+    # other bounds, other entry
+    tsh.insertion_dates(engine, 'lazy-formula', fromdate=utcdt(2020, 1, 2))
+    assert len(histcalls) == 2
+
+    monkeypatch.setattr(tsh, 'auto_idates_ttl', 0)
+    tsh.insertion_dates(engine, 'lazy-formula')
+    assert len(histcalls) == 3
+    assert computed == []
+
+    hist = tsh.history(engine, 'lazy-formula')
+    assert list(hist) == idates
+    assert sorted(computed) == idates
+    assert hist[utcdt(2020, 1, 2)].tolist() == [3., 3.]
+
+    # cleanup
+    FUNCS.pop('lazy-series')
+
+
 def test_expanded(engine, tsh):
     @func('customseries')
     def customseries() -> pd.Series:
@@ -1707,6 +2679,62 @@ def test_expanded_stopnames(engine, tsh):
     )
 
 
+def test_expanded_cache(engine, tsh):
+    tsh.register_formula(
+        engine,
+        'exp-cache-bottom',
+        '(series "exp-cache-a")',
+        False
+    )
+    tsh.register_formula(
+        engine,
+        'exp-cache-top',
+        '(* (/ 1 2) (series "exp-cache-bottom"))',
+        False
+    )
+
+    assert tsh.expanded_formula(engine, 'exp-cache-top') == (
+        '(* (/ 1 2) (series "exp-cache-a"))'
+    )
+    tree = tsh._expanded_formula(
+        engine,
+        tsh.formula(engine, 'exp-cache-top')
+    )
+    assert tree == ['*', ['/', 1, 2], ['series', 'exp-cache-a']]
+    # the constants are only folded for the evaluation
+    assert tsh._expanded(
+        engine,
+        tsh.formula(engine, 'exp-cache-top')
+    ).folded == ['*', 0.5, ['series', 'exp-cache-a']]
+    # served from the cache
+    assert tsh._expanded_formula(
+        engine,
+        tsh.formula(engine, 'exp-cache-top')
+    ) is tree
+
+    # a change in the dependencies invalidates the expansion
+    tsh.register_formula(
+        engine,
+        'exp-cache-bottom',
+        '(series "exp-cache-b")',
+        False,
+        update=True
+    )
+    assert tsh.expanded_formula(engine, 'exp-cache-top') == (
+        '(* (/ 1 2) (series "exp-cache-b"))'
+    )
+    assert tsh._expanded_formula(
+        engine,
+        tsh.formula(engine, 'exp-cache-top')
+    ) == ['*', ['/', 1, 2], ['series', 'exp-cache-b']]
+
+    # stopnames are part of the key
+    assert tsh.expanded_formula(
+        engine, 'exp-cache-top',
+        stopnames=('exp-cache-bottom',)
+    ) == '(* (/ 1 2) (series "exp-cache-bottom"))'
+
+
 # groups
 
 def test_group_formula(engine, tsh):
@@ -97,6 +97,29 @@ def test_series_formula(client, engine):
     assert res.json == {'new-formula': ['test-formula']}
 
 
+def test_series_dependents(client, engine, tsh):
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    tsh.update(engine, series, 'dependents-base', 'Babar')
+    tsh.register_formula(
+        engine,
+        'dependents-f',
+        '(+ 3 (series "dependents-base"))'
+    )
+    tsh.register_formula(
+        engine,
+        'dependents-g',
+        '(+ 5 (series "dependents-f"))'
+    )
+
+    res = client.get('/series/dependents?name=dependents-base')
+    assert res.json == ['dependents-f', 'dependents-g']
+
+    res = client.get('/series/dependents?name=dependents-base&transitive=0')
+    assert res.json == ['dependents-f']
+
+    client.get('/series/dependents?name=no-such-series', status=404)
+
+
 def test_group_formula(client, engine):
     df = gengroup(
         n_scenarios=3,
@@ -1,5 +1,6 @@
 from datetime import datetime as dt
 import math
+import warnings
 import pytz
 import pytest
 
@@ -434,6 +435,62 @@ def test_priority_one_series(engine, tsh):
 """, a)
 
 
+def test_priority_kernel():
+    from tshistory.util import patchmany
+    from tshistory_formula.funcs import series_priority
+
+    def series(values, start, name):
+        return pd.Series(
+            values,
+            index=pd.date_range(utcdt(2019, 1, start), periods=len(values), freq='D'),
+            name=name,
+            dtype='float64'
+        )
+
+    layers = [
+        series([1, 1], 3, 'real'),
+        series([], 1, 'empty'),
+        series([10, 10, 10, 10], 2, 'nom'),
+        series([100] * 7, 1, 'fcst')
+    ]
+    prio = series_priority(*layers)
+    assert prio.name == 'fcst'
+    assert_df("""
+2019-01-01 00:00:00+00:00    100.0
+2019-01-02 00:00:00+00:00     10.0
+2019-01-03 00:00:00+00:00      1.0
+2019-01-04 00:00:00+00:00      1.0
+2019-01-05 00:00:00+00:00     10.0
+2019-01-06 00:00:00+00:00    100.0
+2019-01-07 00:00:00+00:00    100.0
+""", prio)
+    assert prio.equals(patchmany(list(reversed(layers))))
+
+    # aligned layers: the first non empty one wins
+    aligned = [
+        series([], 1, 'empty'),
+        series([1, 2, 3], 1, 'a'),
+        series([4, 5, 6], 1, 'b')
+    ]
+    assert series_priority(*aligned).tolist() == [1, 2, 3]
+
+    # only empty layers
+    empty = [series([], 1, 'a'), series([], 1, 'b')]
+    assert series_priority(*empty) is empty[-1]
+
+    # the input dtype is kept
+    ints = [
+        pd.Series([1, 1], index=layers[0].index, name='a'),
+        pd.Series([10] * 4, index=layers[2].index, name='b')
+    ]
+    prio = series_priority(*ints)
+    assert prio.dtype == 'int64'
+    assert prio.tolist() == [10, 1, 1, 10]
+    prio = series_priority(ints[1], ints[1])
+    assert prio.dtype == 'int64'
+    assert prio.tolist() == [10] * 4
+
+
 def test_clip(engine, tsh):
     tsh.register_formula(
         engine,
@@ -672,6 +729,51 @@ def test_div(engine, tsh):
 """, ts)
 
 
+def test_align_kernel():
+    from tshistory_formula.funcs import _align
+
+    def series(values, start, fill=None):
+        ts = pd.Series(
+            values,
+            index=pd.date_range(utcdt(2019, 1, start), periods=len(values), freq='D'),
+            dtype='float64'
+        )
+        ts.options = {} if fill is None else {'fill': fill}
+        return ts
+
+    serieslist = [
+        series([1, 2, 3, 4, 5], 1),
+        series([1, np.nan, 3], 2, fill='ffill'),
+        series([1, 2], 3, fill='bfill'),
+        series([1, 2], 3, fill='ffill,bfill'),
+        series([7], 6, fill=0)
+    ]
+    index, matrix = _align(serieslist)
+
+    # the reference: the former pandas based implementation
+    df = pd.concat(serieslist, axis=1, join='outer', keys=range(5))
+    for col, ts in enumerate(serieslist):
+        fill = ts.options.get('fill')
+        if isinstance(fill, str):
+            for method in fill.split(','):
+                df[col] = df[col].fillna(method=method.strip())
+        elif fill is not None:
+            df[col] = df[col].fillna(value=fill)
+
+    assert index.equals(df.index)
+    assert np.array_equal(matrix, df.values, equal_nan=True)
+    assert matrix[:, 4].tolist() == [0, 0, 0, 0, 0, 7]
+
+    # an empty series without fill policy entails an empty result
+    assert _align([serieslist[0], series([], 1)]) is None
+    index, matrix = _align([serieslist[0], series([], 1, fill=0)])
+    assert len(index) == 5
+    assert matrix[:, 1].tolist() == [0] * 5
+
+    with pytest.raises(ValueError):
+        _align([serieslist[0], series([1], 1, fill='nope')])
+
+
 def _prepare_row_ops(engine, tsh):
     if tsh.exists(engine, 'station0'):
         return
@@ -880,6 +982,16 @@ def test_std(engine, tsh):
 2015-01-08 00:00:00+00:00    1.0
 """, ts)
 
+    # a single series has no standard deviation, silently
+    from tshistory_formula.funcs import row_std
+    single = pd.Series(
+        [1., 2.],
+        index=pd.date_range(utcdt(2015, 1, 1), periods=2, freq='D')
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert len(row_std(single, skipna=False)) == 0
+
 
 def test_date(engine, tsh):
     e1 = '(date "2018-1-1")'
@@ -1155,6 +1267,18 @@ def test_shift(engine, tsh):
 2020-01-05 07:00:00+00:00    3.0
 """, s1)
 
+    # the shifted series is shared with the other `add` input
+    tsh.register_formula(
+        engine,
+        'test-shift-shared',
+        '(add (shift (series "shifted") #:days 1) (series "shifted"))'
+    )
+    s2 = tsh.get(engine, 'test-shift-shared')
+    assert_df("""
+2020-01-02 00:00:00+00:00    3.0
+2020-01-03 00:00:00+00:00    5.0
+""", s2)
+
 
 def test_rolling(engine, tsh):
     series = pd.Series(
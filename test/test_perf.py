@@ -1,11 +1,19 @@
+import inspect
 from time import time
 
 import pytest
 import numpy as np
 import pandas as pd
+from psyl.lisp import Env, parse
 
 from tshistory.testutil import utcdt
 
+from tshistory_formula.evaluator import (
+    pcompile,
+    pexecute
+)
+from tshistory_formula.registry import FUNCS
+
 
 @pytest.mark.perf
 def test_priority(engine, tsh):
@@ -70,3 +78,122 @@ def test_priority(engine, tsh):
         for _ in range(300):
             patched = tsh.get(engine, 'patch')
     print('100 patches', time() - t0)
+
+
+@pytest.mark.perf
+def test_evaluator_overhead():
+    # a deep scalar tree to measure the per-node cost of the evaluator
+    depth = 100
+    tree = parse('(+ 1 ' * depth + '1' + ')' * depth)
+    env = Env({'+': FUNCS['+']})
+    asyncfuncs = {'series'}
+
+    # the plan is compiled once, as the cached expanded trees do
+    t0 = time()
+    plan = pcompile(tree)
+    compiletime = time() - t0
+
+    t0 = time()
+    for _ in range(100):
+        assert pexecute(plan, env, asyncfuncs) == depth + 1
+    evaltime = time() - t0
+
+    # what we used to pay on each node to identify auto operators
+    t0 = time()
+    for _ in range(100 * depth):
+        hash(inspect.getsource(FUNCS['+']))
+    sourcetime = time() - t0
+
+    pernode = 1e6 * evaltime / (100 * depth)
+    print(f'compilation: {1e6 * compiletime / depth:.2f} µs/node')
+    print(f'evaluation: {pernode:.2f} µs/node')
+    print(f'getsource: {1e6 * sourcetime / (100 * depth):.2f} µs/node')
+    assert evaltime < sourcetime
+
+
+@pytest.mark.perf
+def test_aligned_combination():
+    from tshistory_formula.funcs import (
+        row_max,
+        row_mean,
+        series_add,
+        series_multiply
+    )
+    # an hourly forecast set: many series sharing the same index
+    index = pd.date_range(
+        start=utcdt(2020, 1, 1), freq='H', periods=24 * 365
+    )
+    serieslist = []
+    for idx in range(300):
+        ts = pd.Series(
+            np.random.random(len(index)),
+            index=index.copy()
+        )
+        ts.options = {}
+        serieslist.append(ts)
+
+    # what the operators used to do
+    def concat(serieslist):
+        return pd.concat(
+            serieslist, axis=1, join='outer', keys=range(len(serieslist))
+        )
+
+    reference = {
+        'add': lambda sl: concat(sl).dropna().sum(axis=1),
+        'mul': lambda sl: concat(sl).dropna().prod(axis=1),
+        'row-mean': lambda sl: concat(sl).mean(axis=1).dropna(),
+        'max': lambda sl: concat(sl).max(axis=1).dropna()
+    }
+    operators = {
+        'add': series_add,
+        'mul': series_multiply,
+        'row-mean': row_mean,
+        'max': row_max
+    }
+
+    for name, operator in operators.items():
+        t0 = time()
+        for _ in range(10):
+            expected = reference[name](serieslist)
+        reftime = time() - t0
+
+        t0 = time()
+        for _ in range(10):
+            result = operator(*serieslist)
+        optime = time() - t0
+
+        assert np.allclose(result.values, expected.values, rtol=1e-12, atol=0)
+        print(f'{name}: pandas {reftime:.3f}s, kernel {optime:.3f}s')
+        assert optime < reftime
+
+
+@pytest.mark.perf
+def test_priority_many_layers():
+    from tshistory.util import patchmany
+    from tshistory_formula.funcs import series_priority
+
+    # realized, nominated and many overlapping forecasts
+    layers = []
+    for idx in range(15):
+        layers.append(
+            pd.Series(
+                np.random.random(24 * 365),
+                index=pd.date_range(
+                    start=utcdt(2020, 1, 1 + idx), freq='H', periods=24 * 365
+                )
+            )
+        )
+
+    t0 = time()
+    for _ in range(10):
+        expected = patchmany(list(reversed(layers)))
+    reftime = time() - t0
+
+    t0 = time()
+    for _ in range(10):
+        result = series_priority(*layers)
+    optime = time() - t0
+
+    assert np.array_equal(result.values, expected.values)
+    print(f'priority: patchmany {reftime:.3f}s, kernel {optime:.3f}s')
+    assert optime < reftime
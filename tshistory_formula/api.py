@@ -1,9 +1,12 @@
-from typing import Optional, Dict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Iterator, List, Tuple
 
 import pandas as pd
 
-from psyl.lisp import parse
-from tshistory.util import extend
+from tshistory.util import (
+    ensuretz,
+    extend
+)
 from tshistory.api import (
     altsources,
     dbtimeseries
@@ -78,9 +81,7 @@ def formula_components(self,
     {'my-series-2': [{'sub-component-1': ['component-a', 'component-b']}, 'component-b']}
 
     """
-    form = self.formula(name)
-
-    if form is None:
+    if self.tsh.formula(self.engine, name) is None:
         if not self.tsh.exists(self.engine, name):
             return self.othersources.formula_components(
                 name,
@@ -88,43 +89,158 @@ def formula_components(self,
             )
         return
 
-    parsed = parse(form)
-    names = list(
-        self.tsh.find_series(self.engine, parsed)
-    )
+    deps = self.tsh.dependencies(self.engine, name, transitive=expanded)
 
-    # compute expansion of the remotely defined formula
-    remotes = [
-        name for name in names
-        if not self.tsh.exists(self.engine, name)
-        and self.formula(name)
-    ]
-    if remotes:
-        # remote names will be replaced with their expansion
-        rnames = []
-        for rname in names:
-            if rname in remotes:
-                rnames.append(
-                    self.othersources.formula_components(rname, expanded)
+    def components(fname):
+        names = []
+        for cname, ctype in deps.get(fname, ()):
+            if ctype is None and self.formula(cname):
+                # remotely defined formula: replaced with its expansion
+                names.append(
+                    self.othersources.formula_components(cname, expanded)
                 )
+            elif expanded and ctype == 'formula':
+                # pass through some formula walls
+                # where expansion > formula expansion
+                names.append(components(cname))
             else:
-                rnames.append(rname)
-        names = rnames
-
-    if expanded:
-        # pass through some formula walls
-        # where expansion > formula expansion
-        subnames = []
-        for cname in names:
-            if not isinstance(cname, str) or not self.formula(cname):
-                subnames.append(cname)
-                continue
-            subnames.append(
-                self.formula_components(cname, expanded)
-            )
-        names = subnames
+                names.append(cname)
+        return {fname: names}
+
+    return components(name)
+
+
+@extend(dbtimeseries)
+def dependents(self,
+               name: str,
+               transitive: bool=True) -> List[str]:
+    """Return the names of the formulas whose value can change when
+    the given series is updated.
+
+    If `transitive` is false, only the formulas directly referencing
+    it are returned.
+
+    >>> dependents('component-a')
+    ['show-components', 'show-components-squared']
+
+    """
+    return self.tsh.dependents(
+        self.engine,
+        name,
+        transitive=transitive
+    )
+
+
+@extend(dbtimeseries)
+def materialize(self,
+                name: str,
+                materialized: bool=True) -> NONETYPE:
+    """Flag a formula as materialized (or not, if `materialized` is
+    false).
+
+    The last version of a materialized formula is stored: it is served
+    by `get` when no `revision_date` is given and recomputed (lazily)
+    after any of its components has been updated.
 
-    return {name: names}
+    """
+    self.tsh.materialize(self.engine, name, materialized)
+
+
+@extend(dbtimeseries)
+def iterhistory(self,
+                name: str,
+                from_insertion_date: Optional[datetime]=None,
+                to_insertion_date: Optional[datetime]=None,
+                from_value_date: Optional[datetime]=None,
+                to_value_date: Optional[datetime]=None,
+                diffmode: bool=False,
+                _keep_nans: bool=False) -> Iterator[Tuple[datetime, pd.Series]]:
+    """Like `history`, but yield the (insertion date, version) pairs
+    in order instead of returning a dict.
+
+    The versions of a formula are computed as they are consumed, hence
+    memory does not grow with the number of versions.
+
+    >>> for idate, ts in iterhistory('my-formula'):
+    ...     ts.to_frame().to_parquet(f'my-formula-{idate:%Y%m%d%H%M}.parquet')
+
+    """
+    from_insertion_date = ensuretz(from_insertion_date)
+    to_insertion_date = ensuretz(to_insertion_date)
+
+    if not self.tsh.exists(self.engine, name):
+        hist = self.othersources.history(
+            name,
+            from_insertion_date=from_insertion_date,
+            to_insertion_date=to_insertion_date,
+            from_value_date=from_value_date,
+            to_value_date=to_value_date,
+            diffmode=diffmode,
+            _keep_nans=_keep_nans
+        )
+        if hist:
+            yield from hist.items()
+        return
+
+    yield from self.tsh.iterhistory(
+        self.engine,
+        name,
+        from_insertion_date=from_insertion_date,
+        to_insertion_date=to_insertion_date,
+        from_value_date=from_value_date,
+        to_value_date=to_value_date,
+        diffmode=diffmode,
+        _keep_nans=_keep_nans
+    )
+
+
+@extend(dbtimeseries)
+def staircases(self,
+               name: str,
+               deltas: List[timedelta],
+               from_value_date: Optional[datetime]=None,
+               to_value_date: Optional[datetime]=None) -> Optional[pd.DataFrame]:
+    """Like `staircase`, for several deltas at once: return a dataframe
+    with one column per delta.
+
+    The revisions are read only once, hence this is much cheaper than
+    calling `staircase` for each delta.
+
+    >>> staircases('my-forecast', [pd.Timedelta(hours=h) for h in range(24)])
+
+    """
+    df = self.tsh.staircases(
+        self.engine,
+        name,
+        deltas,
+        from_value_date=from_value_date,
+        to_value_date=to_value_date
+    )
+    if df is None:
+        df = self.othersources.staircases(
+            name,
+            deltas,
+            from_value_date=from_value_date,
+            to_value_date=to_value_date
+        )
+    return df
+
+
+@extend(altsources)
+def staircases(self,
+               name: str,
+               deltas: List[timedelta],
+               from_value_date: Optional[datetime]=None,
+               to_value_date: Optional[datetime]=None) -> Optional[pd.DataFrame]:
+    source = self._findsourcefor(name)
+    if source is None:
+        return
+    return source.tsa.staircases(
+        name,
+        deltas,
+        from_value_date=from_value_date,
+        to_value_date=to_value_date
+    )
 
 
 @extend(altsources)
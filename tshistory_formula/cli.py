@@ -178,6 +178,92 @@ def migrate_to_groups(db_uri, namespace='tsh'):
         cn.execute(sql)
 
 
+@click.command(name='migrate-to-formula-cache')
+@click.argument('db-uri')
+@click.option('--namespace', default='tsh')
+def migrate_to_formula_cache(db_uri, namespace='tsh'):
+    engine = create_engine(find_dburi(db_uri))
+
+    ns = namespace
+    sql = f"""
+    create table if not exists "{ns}".formula_version (
+      version bigint not null
+    );
+
+    insert into "{ns}".formula_version (version)
+    select 0
+    where not exists (select 1 from "{ns}".formula_version);
+    """
+
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
+@click.command(name='migrate-to-formula-dependencies')
+@click.argument('db-uri')
+@click.option('--namespace', default='tsh')
+def migrate_to_formula_dependencies(db_uri, namespace='tsh'):
+    "create and fill the formula dependency index"
+    engine = create_engine(find_dburi(db_uri))
+
+    ns = namespace
+    sql = f"""
+    create table if not exists "{ns}".formula_dependency (
+      id serial primary key,
+      name text not null references "{ns}".formula (name)
+           on delete cascade on update cascade,
+      kind text not null,
+      ref text not null,
+      unique (name, kind, ref)
+    );
+
+    create index if not exists "ix_{ns}_formula_dependency_ref"
+    on "{ns}".formula_dependency (ref);
+    """
+
+    tsh = timeseries(namespace)
+    with engine.begin() as cn:
+        cn.execute(sql)
+        formulas = cn.execute(
+            f'select name, text from "{ns}".formula'
+        ).fetchall()
+        for name, text in formulas:
+            tsh._register_dependencies(cn, name, parse(text))
+    print(f'indexed the dependencies of {len(formulas)} formulas')
+
+
+@click.command(name='migrate-to-materialized-formulas')
+@click.argument('db-uri')
+@click.option('--namespace', default='tsh')
+def migrate_to_materialized_formulas(db_uri, namespace='tsh'):
+    engine = create_engine(find_dburi(db_uri))
+
+    ns = namespace
+    sql = f"""
+    create table if not exists "{ns}".formula_materialized (
+      name text primary key references "{ns}".formula (name)
+           on delete cascade on update cascade,
+      series bytea,
+      stale bool not null default true,
+      generation bigint not null default 0
+    );
+    """
+
+    with engine.begin() as cn:
+        cn.execute(sql)
+
+
+@click.command(name='refresh-materialized-formulas')
+@click.argument('db-uri')
+@click.option('--namespace', default='tsh')
+def refresh_materialized_formulas(db_uri, namespace='tsh'):
+    "recompute the stale materialized formulas"
+    engine = create_engine(find_dburi(db_uri))
+    tsh = timeseries(namespace)
+    for name in tsh.refresh_materialized(engine):
+        print('refreshed', name)
+
+
 @click.command(name='shell')
 @click.argument('db-uri')
 @click.option('--namespace', default='tsh')
@@ -1,20 +1,16 @@
-import inspect
-
 from concurrent.futures import (
     Future
 )
 
 from psyl.lisp import (
     buildargs,
-    quasiexpreval
+    Keyword,
+    quasiexpreval,
+    Symbol
 )
 
 from tshistory_formula.helper import ThreadPoolExecutor
-
-
-
-def funcid(func):
-    return hash(inspect.getsource(func))
+from tshistory_formula.registry import FUNCS
 
 
 # parallel evaluator
@@ -41,28 +37,198 @@ def pexpreval(tree, env, asyncfuncs=(), pool=None, hist=False):
     else:
         func = proc
 
+    # the operator identity has been set at registration time
+    auto = getattr(func, 'auto', False) and func.opname in asyncfuncs
+
     # for autotrophic operators: prepare to pass the tree if present
-    funkey = funcid(func)
-    if hist and funkey in asyncfuncs:
+    if hist and auto:
         kwargs['__tree__'] = tree
 
-    if funkey in asyncfuncs and pool:
+    if auto and pool:
         return pool.submit(proc, *posargs, **kwargs)
 
     return proc(*posargs, **kwargs)
 
 
-def pevaluate(expr, env, asyncfuncs=(), concurrency=16, hist=False):
+# compiled evaluation plans
+
+# symbols bound to constants in every interpreter
+_CONSTANTS = {
+    '#t': True,
+    '#f': False
+}
+
+
+class Step:
+    """One operator call of a plan (or a symbol lookup if `op` is
+    None).
+
+    The `args` and `kwargs` hold the constant arguments, while
+    `argslots` and `kwslots` map the remaining positions/keywords to
+    the results of previous steps.
+    """
+    __slots__ = ('op', 'tree', 'args', 'kwargs', 'argslots', 'kwslots')
+
+    def __init__(self, op, tree, args=(), kwargs=None,
+                 argslots=(), kwslots=()):
+        self.op = op
+        self.tree = tree
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.argslots = argslots
+        self.kwslots = kwslots
+
+
+class Plan:
+    """A formula tree compiled into a flat list of steps.
+
+    Structurally identical subtrees are compiled into one step, hence
+    evaluated once and their value shared by all their consumers.
+
+    The auto operators (which do the I/O) are scheduled first, so that
+    they can all be running in the pool before we need any of them.
+    The plan does not depend on the interpreter and can be reused at
+    will.
+    """
+    __slots__ = ('steps', 'result', 'isref')
+
+    def __init__(self, steps, result, isref):
+        self.steps = steps
+        self.result = result
+        self.isref = isref
+
+
+def _isauto(op):
+    return getattr(FUNCS.get(op), 'auto', False)
+
+
+def _structkey(tree):
+    # the type is part of the key: Symbol("a") == "a" and 1 == 1.0
+    if isinstance(tree, list):
+        return tuple(_structkey(item) for item in tree)
+    return (type(tree), tree)
+
+
+def pcompile(tree):
+    steps = []
+    slots = {}
+
+    def emit(tree, key):
+        # returns a (isref, value) pair
+        if isinstance(tree, Symbol):
+            if tree in _CONSTANTS:
+                return False, _CONSTANTS[tree]
+            steps.append(Step(None, tree))
+            return True, len(steps) - 1
+        if not isinstance(tree, list):
+            return False, tree
+        slot = slots.get(key)
+        if slot is not None:
+            # common subexpression
+            return True, slot
+
+        items = [
+            emit(item, itemkey)
+            for item, itemkey in zip(tree[1:], key[1:])
+        ]
+        args, kwargs = [], {}
+        argslots, kwslots = [], []
+        kw = None
+        for isref, value in items:
+            if kw is not None:
+                if isref:
+                    kwslots.append((kw, value))
+                else:
+                    kwargs[kw] = value
+                kw = None
+                continue
+            if not isref and isinstance(value, Keyword):
+                kw = value
+                continue
+            if isref:
+                argslots.append((len(args), value))
+                value = None
+            args.append(value)
+
+        steps.append(
+            Step(tree[0], tree, args, kwargs, argslots, kwslots)
+        )
+        slot = slots[key] = len(steps) - 1
+        return True, slot
+
+    def hoist(tree, key):
+        if not isinstance(tree, list):
+            return
+        if _isauto(tree[0]):
+            emit(tree, key)
+            return
+        for item, itemkey in zip(tree[1:], key[1:]):
+            hoist(item, itemkey)
+
+    key = _structkey(tree)
+    hoist(tree, key)
+    isref, result = emit(tree, key)
+    return Plan(steps, result, isref)
+
+
+def _resolved(value):
+    if isinstance(value, Future):
+        return value.result()
+    return value
+
+
+def pexecute(plan, env, asyncfuncs=(), pool=None, hist=False):
+    values = []
+    for step in plan.steps:
+        if step.op is None:
+            values.append(env.find(step.tree))
+            continue
+
+        args = step.args
+        if step.argslots:
+            args = list(args)
+            for pos, slot in step.argslots:
+                args[pos] = _resolved(values[slot])
+        kwargs = step.kwargs
+        if step.kwslots:
+            kwargs = dict(kwargs)
+            for kw, slot in step.kwslots:
+                kwargs[kw] = _resolved(values[slot])
+
+        proc = env.find(step.op)
+        func = getattr(proc, 'func', proc)
+        auto = getattr(func, 'auto', False) and func.opname in asyncfuncs
+
+        # for autotrophic operators: prepare to pass the tree if present
+        if hist and auto:
+            kwargs = dict(kwargs, __tree__=step.tree)
+
+        if auto and pool:
+            values.append(pool.submit(proc, *args, **kwargs))
+        else:
+            values.append(proc(*args, **kwargs))
+
+    if not plan.isref:
+        return plan.result
+    return _resolved(values[plan.result])
+
+
+def pevaluate(expr, env, asyncfuncs=(), concurrency=16, hist=False,
+              pool=None):
+    """Evaluate a tree (or plan), running the auto operators in a
+    thread pool.
+
+    If a shared `pool` (WorkerPool) is provided, at most `concurrency`
+    auto operators of this evaluation will run at once in it.
+    Otherwise a private pool is built for the duration of the call.
+    """
+    plan = expr if isinstance(expr, Plan) else pcompile(expr)
     if asyncfuncs:
+        if pool is not None:
+            with pool.session(concurrency) as session:
+                return pexecute(plan, env, asyncfuncs, session, hist)
+
         with ThreadPoolExecutor(concurrency) as pool:
-            val = pexpreval(
-                expr, env,
-                {funcid(func) for func in asyncfuncs},
-                pool,
-                hist
-            )
-            if isinstance(val, Future):
-                val = val.result()
-        return val
-
-    return pexpreval(expr, env, asyncfuncs, hist)
+            return pexecute(plan, env, asyncfuncs, pool, hist)
+
+    return pexecute(plan, env, asyncfuncs, hist=hist)
@@ -2,6 +2,7 @@ from datetime import timedelta
 from typing import Union, Optional, Tuple
 from numbers import Number
 import calendar
+import warnings
 
 import numpy as np
 import pandas as pd
@@ -34,7 +35,7 @@ def make_list(*a: object) -> Tuple[object]:
     return a
 
 
-@func('options')
+@func('options', staircase=True)
 def options(series: pd.Series,
             fill: Union[str, Number, NONETYPE]=None,
             prune: Optional[int]=None,
@@ -58,8 +59,11 @@ def options(series: pd.Series,
     later use while `prune` is applied immediately.
 
     """
+    # the input series may be shared: don't touch its options
     if prune:
         series = series[:-prune]
+    else:
+        series = series.copy(deep=False)
 
     series.options = {
         'fill': fill
@@ -71,7 +75,7 @@ def options(series: pd.Series,
     return series
 
 
-@func('series', auto=True)
+@func('series', auto=True, staircase=True, pointwise=True)
 def series(__interpreter__,
            name: seriesname,
            fill: Union[str, Number, NONETYPE]=None,
@@ -102,13 +106,18 @@ def series(__interpreter__,
     i = __interpreter__
     ts = i.get(name, i.getargs)
     if ts is None:
-        if not i.tsh.exists(i.cn, name): # that should be turned into an assertion
-            raise ValueError(f'No such series `{name}`')
-        meta = i.tsh.metadata(i.cn, name)
+        with i.connection() as cn:
+            if not i.tsh.exists(cn, name): # that should be turned into an assertion
+                raise ValueError(f'No such series `{name}`')
+            meta = i.tsh.metadata(cn, name)
         ts = empty_series(meta['tzaware'], name=name)
 
+    # the fetched series may be shared (e.g. from a precomputed
+    # history): don't touch its options
     if prune:
         ts = ts[:-prune]
+    else:
+        ts = ts.copy(deep=False)
     ts.options = {
         'fill': fill
     }
@@ -155,11 +164,15 @@ def naive(series: pd.Series, tzone: str) -> pd.Series:
     if not tzaware_serie(series):
         return dedupe(series)
 
+    # the input series may be shared: work on a shallow copy
+    options = series.options
+    series = series.copy(deep=False)
+    series.options = options
     series.index = series.index.tz_convert(tzone).tz_localize(None)
     return dedupe(series)
 
 
-@func('date')
+@func('date', staircase=True)
 def timestamp(strdate: str,
               tz: Optional[str]='UTC') -> pd.Timestamp:
     """
@@ -176,7 +189,7 @@ def timestamp(strdate: str,
     return pd.Timestamp(strdate, tz=tz)
 
 
-@func('timedelta')
+@func('timedelta', staircase=True)
 def timedelta_eval(date: pd.Timestamp,
                    years: int=0,
                    months: int=0,
@@ -340,7 +353,7 @@ def constant_idates(cn, tsh, tree, fromdate, todate):
     return [revdate]
 
 
-@func('+')
+@func('+', staircase=True, pointwise=True)
 def scalar_add(
         num: Number,
         num_or_series: Union[Number, pd.Series]) -> Union[Number, pd.Series]:
@@ -362,7 +375,7 @@ def scalar_add(
     return res
 
 
-@func('*')
+@func('*', staircase=True, pointwise=True)
 def scalar_prod(
         num: Number,
         num_or_series: Union[Number, pd.Series]) -> Union[Number, pd.Series]:
@@ -384,7 +397,7 @@ def scalar_prod(
     return res
 
 
-@func('/')
+@func('/', staircase=True, pointwise=True)
 def scalar_div(
         num_or_series: Union[Number, pd.Series],
         num: Number) -> Union[Number, pd.Series]:
@@ -404,52 +417,141 @@ def scalar_div(
     return res
 
 
-def _fill(df, colname, fillopt):
-    """ in-place application of the series fill policies
-    which can be a int/float or a coma separated string
+def _ffill(matrix):
+    """ column-wise forward fill of a float matrix """
+    valid = ~np.isnan(matrix)
+    rows = np.where(
+        valid,
+        np.arange(len(matrix))[:, None],
+        0
+    )
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return np.take_along_axis(matrix, rows, axis=0)
+
+
+def _bfill(matrix):
+    """ column-wise backward fill of a float matrix """
+    return _ffill(matrix[::-1])[::-1]
+
+
+FILLERS = {
+    'ffill': _ffill,
+    'pad': _ffill,
+    'bfill': _bfill,
+    'backfill': _bfill
+}
+
+
+def _fill(matrix, fillopts):
+    """ in-place application of the series fill policies (one per
+    matrix column) which can be a int/float or a coma separated string
     like e.g. 'ffill,bfill'
+
+    Columns sharing a policy are filled together.
+    """
+    bypolicy = {}
+    for col, fillopt in enumerate(fillopts):
+        if isinstance(fillopt, (str, int, float)):
+            bypolicy.setdefault(fillopt, []).append(col)
+
+    for fillopt, cols in bypolicy.items():
+        sub = matrix[:, cols]
+        if isinstance(fillopt, str):
+            for method in fillopt.split(','):
+                method = method.strip()
+                if method not in FILLERS:
+                    raise ValueError(
+                        'Invalid fill method. Expecting pad (ffill) or '
+                        f'backfill (bfill). Got {method}'
+                    )
+                sub = FILLERS[method](sub)
+        else:
+            sub[np.isnan(sub)] = fillopt
+        matrix[:, cols] = sub
+
+
+def _same_index(index, other):
+    """ cheap identity test of two series indexes """
+    if other is index:
+        return True
+    if len(other) != len(index):
+        return False
+    # on datetime indexes, this is a plain array comparison
+    return index.equals(other)
+
+
+def _union_index(serieslist):
+    """ returns the union index of the non-empty input series (built
+    once) and whether they were already aligned
     """
-    if isinstance(fillopt, str):
-        for method in fillopt.split(','):
-            df[colname] = df[colname].fillna(
-                method=method.strip()
-            )
-    elif isinstance(fillopt, (int, float)):
-        df[colname] = df[colname].fillna(
-            value=fillopt
-        )
+    indexes = [
+        ts.index for ts in serieslist
+        if len(ts)
+    ] or [serieslist[0].index]
+    index = indexes[0]
+
+    # fast path: the inputs share the same index
+    if all(_same_index(index, other) for other in indexes[1:]):
+        return index, True
 
+    for other in indexes[1:]:
+        if other is not index:
+            index = index.union(other)
+    return index, False
 
-def _group_series(*serieslist):
-    dfs = []
-    opts = {}
 
-    # join everything
-    for idx, ts in enumerate(serieslist):
-        if ts.options.get('fill') is None and not len(ts):
-            # at least one series without fill policy and no data
-            # entails an empty result
-            return pd.DataFrame(dtype='float64')
+def _align(serieslist, fill=True):
+    """ alignment kernel of the combination operators
 
-        ts.name = f'{idx}'  # do something unique
-        fillopt = (
-            ts.options['fill']
-            if ts.options.get('fill') is not None
-            else None
+    Returns the union index of the input series and a float matrix
+    holding one column per series, with the fill policies applied,
+    or None if one series without fill policy has no data (which
+    entails an empty result).
+
+    With `fill` set to False, the fill policies are ignored and the
+    empty series are only accounted as missing values.
+    """
+    if fill:
+        for ts in serieslist:
+            if ts.options.get('fill') is None and not len(ts):
+                return None
+
+    index, aligned = _union_index(serieslist)
+
+    # the matrices are column major: each series is written contiguously
+    if aligned:
+        matrix = np.empty((len(serieslist), len(index))).T
+        for col, ts in enumerate(serieslist):
+            matrix[:, col] = ts.values if len(ts) else np.nan
+    else:
+        # each series is scattered into its matrix column
+        matrix = np.full((len(serieslist), len(index)), np.nan).T
+        for col, ts in enumerate(serieslist):
+            matrix[index.get_indexer(ts.index), col] = ts.values
+
+    if fill:
+        _fill(
+            matrix,
+            [ts.options.get('fill') for ts in serieslist]
         )
-        opts[ts.name] = fillopt
-        dfs.append(ts)
+    return index, matrix
 
-    df = pd.concat(dfs, axis=1, join='outer')
 
-    # apply the filling rules
-    for name, fillopt in opts.items():
-        _fill(df, name, fillopt)
+def _valid_rows(index, values):
+    """ builds a series out of the non-nan values """
+    mask = ~np.isnan(values)
+    return pd.Series(values[mask], index=index[mask])
 
-    return df
+
+def _complete_rows(index, matrix, values):
+    """ builds a series out of the row-wise `values` computed from the
+    rows of `matrix` having no missing value
+    """
+    mask = ~np.isnan(matrix).any(axis=1)
+    return pd.Series(values[mask], index=index[mask])
 
 
-@func('add')
+@func('add', staircase=True, pointwise=True)
 def series_add(*serieslist: pd.Series) -> pd.Series:
     """
     Linear combination of two or more series. Takes a variable number
@@ -470,10 +572,17 @@ def series_add(*serieslist: pd.Series) -> pd.Series:
         for s in serieslist
     ]
 
-    return _group_series(*serieslist).dropna().sum(axis=1)
+    aligned = _align(serieslist)
+    if aligned is None:
+        return empty_series(
+            tzaware_serie(serieslist[0])
+        )
+
+    index, matrix = aligned
+    return _complete_rows(index, matrix, matrix.sum(axis=1))
 
 
-@func('mul')
+@func('mul', staircase=True, pointwise=True)
 def series_multiply(*serieslist: pd.Series) -> pd.Series:
     """
     Element wise multiplication of series. Takes a variable number of
@@ -485,40 +594,37 @@ def series_multiply(*serieslist: pd.Series) -> pd.Series:
     in euros, using a currency exchange rate series with a
     forward-fill option.
     """
-    df = _group_series(*serieslist)
-    if not len(df):
+    aligned = _align(serieslist)
+    if aligned is None:
         return empty_series(
             tzaware_serie(serieslist[0])
         )
 
-    res = None
-    for col in df.columns:
-        if res is None:
-            res = df[col].to_frame()
-            continue
-        res = res.multiply(df[col], axis=0)
+    index, matrix = aligned
+    return _complete_rows(index, matrix, matrix.prod(axis=1))
 
-    return res[res.columns[0]].dropna()
 
-
-@func('div')
+@func('div', staircase=True, pointwise=True)
 def series_div(s1: pd.Series, s2: pd.Series) -> pd.Series:
     """
     Element wise division of two series.
 
     Example: `(div (series "$-to-€") (series "€-to-£"))`
     """
-    df = _group_series(*(s1, s2))
-    if not len(df) or len(df.columns) < 2:
+    aligned = _align((s1, s2))
+    if aligned is None:
         return empty_series(
             tzaware_serie(s1)
         )
 
-    c1, c2 = df.columns
-    return (df[c1] / df[c2]).dropna()
+    index, matrix = aligned
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = matrix[:, 0] / matrix[:, 1]
+    # like pandas, we keep the infinities but drop the nans
+    return _valid_rows(index, values)
 
 
-@func('priority')
+@func('priority', staircase=True, pointwise=True)
 def series_priority(*serieslist: pd.Series) -> pd.Series:
     """
     The priority operator combines its input series as layers. For
@@ -533,12 +639,44 @@ def series_priority(*serieslist: pd.Series) -> pd.Series:
     if len(serieslist) == 1:
         return serieslist[0]
 
-    series = list(serieslist)
-    series.reverse()
-    return patchmany(series)
+    # the empty layers do not weigh on the result dtype
+    dtypes = [ts.dtype for ts in serieslist if len(ts)]
+    if any(not isinstance(dtype, np.dtype) or dtype == 'object'
+           for dtype in dtypes):
+        series = list(serieslist)
+        series.reverse()
+        return patchmany(series)
+
+    # the lowest priority layer gives its name to the result
+    last = serieslist[-1]
+    index, aligned = _union_index(serieslist)
+    if not len(index):
+        # only empty layers
+        return last
+
+    dtype = np.result_type(*dtypes)
+    if aligned:
+        # the first non empty layer covers everything
+        values = np.array(
+            next(ts for ts in serieslist if len(ts)).values,
+            dtype=dtype
+        )
+    else:
+        # single pass over the layers, from the lowest priority one:
+        # each layer overwrites its positions in the union index
+        values = np.zeros(len(index), dtype=dtype)
+        for ts in reversed(serieslist):
+            if len(ts):
+                values[index.get_indexer(ts.index)] = ts.values
 
+    return pd.Series(
+        values,
+        index=index,
+        name=last.name
+    )
 
-@func('clip')
+
+@func('clip', pointwise=True)
 def series_clip(series: pd.Series,
                 min: Optional[Number]=None,
                 max: Optional[Number]=None,
@@ -557,19 +695,20 @@ def series_clip(series: pd.Series,
     if max is not None:
         mask = series <= max
         if replacemax:
-            series[~mask] = max
+            # the input series may be shared: don't write into it
+            series = series.where(mask, max)
         else:
             series = series[mask]
     if min is not None:
         mask = series >= min
         if replacemin:
-            series[~mask] = min
+            series = series.where(mask, min)
         else:
             series = series[mask]
     return series
 
 
-@func('slice')
+@func('slice', staircase=True)
 def slice(series: pd.Series,
           fromdate: Optional[pd.Timestamp]=None,
           todate: Optional[pd.Timestamp]=None) -> pd.Series:
@@ -598,7 +737,7 @@ def slice(series: pd.Series,
     return sliced
 
 
-@func('row-mean')
+@func('row-mean', staircase=True, pointwise=True)
 def row_mean(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     This operator computes the row-wise mean of its input series using
@@ -610,34 +749,37 @@ def row_mean(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     Weights are provided as a keyword to `series`. No weight is
     interpreted as 1.
     """
-    weights = [
+    weights = np.array([
         series.options.get('weight', 1)
         for series in serieslist
-    ]
+    ])
 
-    allseries = pd.concat(serieslist, axis=1)
-    weights_in_vertical_matrix = np.array(
-        [[w] for w in weights]
-    )
+    index, matrix = _align(serieslist, fill=False)
+    missing = np.isnan(matrix)
     if skipna:
-        weighted_sum = allseries.fillna(0).values.dot(
-            weights_in_vertical_matrix
-        )
+        weighted_sum = np.where(missing, 0, matrix).dot(weights)
     else:
-        weighted_sum = allseries.values.dot(
-            weights_in_vertical_matrix
-        )
-    denominator = (~allseries.isnull()).values.dot(
-        weights_in_vertical_matrix
-    )
+        weighted_sum = matrix.dot(weights)
+    denominator = (~missing).dot(weights)
 
-    return pd.Series(
-        (weighted_sum / denominator).flatten(),
-        index=allseries.index
-    ).dropna()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _valid_rows(index, weighted_sum / denominator)
+
+
+def _row_reduce(serieslist, func, nanfunc, skipna, **kw):
+    index, matrix = _align(serieslist, fill=False)
+    # the rows without a result (all-nan rows, or too few values for
+    # the degrees of freedom) are expected and dropped afterwards
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if skipna:
+            values = nanfunc(matrix, axis=1, **kw)
+        else:
+            values = func(matrix, axis=1, **kw)
+    return _valid_rows(index, values)
 
 
-@func('min')
+@func('min', staircase=True, pointwise=True)
 def row_min(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the row-wise minimum of its input series.
@@ -648,11 +790,10 @@ def row_min(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     The `skipna` keyword (which is true by default) controls the
     behaviour with nan values.
     """
-    allseries = pd.concat(serieslist, axis=1)
-    return allseries.min(axis=1, skipna=skipna).dropna()
+    return _row_reduce(serieslist, np.min, np.nanmin, skipna)
 
 
-@func('max')
+@func('max', staircase=True, pointwise=True)
 def row_max(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the row-wise maximum of its input series.
@@ -663,11 +804,10 @@ def row_max(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     The `skipna` keyword (which is true by default) controls the
     behaviour with nan values.
     """
-    allseries = pd.concat(serieslist, axis=1)
-    return allseries.max(axis=1, skipna=skipna).dropna()
+    return _row_reduce(serieslist, np.max, np.nanmax, skipna)
 
 
-@func('std')
+@func('std', staircase=True, pointwise=True)
 def row_std(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the standard deviation over its input series.
@@ -678,8 +818,7 @@ def row_std(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     The `skipna` keyword (which is true by default) controls the
     behaviour with nan values.
     """
-    allseries = pd.concat(serieslist, axis=1)
-    return allseries.std(axis=1, skipna=skipna).dropna()
+    return _row_reduce(serieslist, np.std, np.nanstd, skipna, ddof=1)
 
 
 @func('resample')
@@ -733,6 +872,10 @@ def shift(series: pd.Series,
     Example `(shift (series "shifted") #:days 2 #:hours 7)`
 
     """
+    # the input series may be shared: work on a shallow copy
+    options = series.options
+    series = series.copy(deep=False)
+    series.options = options
     # note: relativedelta is unfit there as it cannot be
     # broadcast on the index
     series.index = series.index + timedelta(
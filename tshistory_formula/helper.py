@@ -5,10 +5,14 @@ import itertools
 import queue
 import re
 import threading
+from collections import deque
 from concurrent.futures import _base
+from contextlib import contextmanager
 from numbers import Number
 
 import pandas as pd
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from psyl.lisp import (
     Env,
     evaluate,
@@ -19,10 +23,7 @@ from psyl.lisp import (
     Symbol
 )
 
-from tshistory_formula.registry import (
-    METAS,
-    FUNCS
-)
+from tshistory_formula.registry import FUNCS
 
 
 NONETYPE = type(None)
@@ -49,29 +50,38 @@ def extract_auto_options(tree):
     return options
 
 
-def expanded(tsh, cn, tree, stopnames=()):
+def expanded(tsh, cn, tree, stopnames=(), deps=None):
+    """Recursively replace the references to formulas by their
+    definition.
+
+    If a `deps` dict is provided, it is filled with a mapping from
+    each referenced series name to its formula text (or None for a
+    non-formula).
+    """
     # base case: check the current operation
     op = tree[0]
     if op == 'series':
-        metas = METAS.get(op)
-        seriesmeta = metas(cn, tsh, tree) if metas else None
-        name, _ = seriesmeta.popitem()
+        name = tree[1]
         if name in stopnames:
             return tree
+        formula = None
         if tsh.type(cn, name) == 'formula':
             formula = tsh.formula(cn, name)
+        if deps is not None:
+            deps[name] = formula
+        if formula:
             options = extract_auto_options(tree)
             if not options:
-                return expanded(tsh, cn, parse(formula), stopnames)
+                return expanded(tsh, cn, parse(formula), stopnames, deps)
             return [
                 Symbol('options'),
-                expanded(tsh, cn, parse(formula), stopnames),
+                expanded(tsh, cn, parse(formula), stopnames, deps),
             ] + options
 
     newtree = []
     for item in tree:
         if isinstance(item, list):
-            newtree.append(expanded(tsh, cn, item, stopnames))
+            newtree.append(expanded(tsh, cn, item, stopnames, deps))
         else:
             newtree.append(item)
     return newtree
@@ -466,6 +476,8 @@ class _WorkItem(object):
         self.kwargs = kwargs
 
     def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
         try:
             result = self.fn(*self.args, **self.kwargs)
         except BaseException as exc:
@@ -525,3 +537,271 @@ class ThreadPoolExecutor:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.shutdown()
         return False
+
+
+# shared worker pool
+
+_local = threading.local()
+
+
+def inworker():
+    "are we running in a `WorkerPool` thread ?"
+    return getattr(_local, 'worker', False)
+
+
+def warm_indexes(serieslist):
+    """Build the lazy caches (monotonicity, uniqueness, hash table) of
+    the indexes of series about to be read from several threads:
+    pandas does not build them in a thread-safe way.
+    """
+    for ts in serieslist:
+        index = ts.index
+        index.is_unique, index.is_monotonic_increasing
+        index.get_indexer(index[:1])
+
+
+class PoolSession:
+    """A request-scoped view on a `WorkerPool`: at most `limit` of its
+    work items run at the same time.
+
+    On exit, it waits for all its work items, since they may be using
+    the request connection.
+    """
+
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.limit = limit
+        self.queue = deque()
+        self.running = 0
+        self.scheduled = False
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        f = _base.Future()
+        item = _WorkItem(f, fn, args, kwargs)
+        if inworker():
+            # nested evaluation from within a worker: waiting on
+            # the pool from there could deadlock, hence run in place
+            item.run()
+            return f
+
+        self.futures.append(f)
+        self.pool._submit(self, item)
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            for f in self.futures:
+                f.cancel()
+        _base.wait(self.futures)
+        return False
+
+
+class WorkerPool:
+    """A pool of worker threads shared by the concurrent requests.
+
+    Threads are started on demand up to `max_workers` and then live as
+    long as the process. The work items of the sessions are served in
+    a round-robin fashion.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        # sessions having queued work items
+        self._sessions = deque()
+        self._threads = []
+        self._idle = 0
+
+    def session(self, limit):
+        return PoolSession(self, limit)
+
+    def _submit(self, session, item):
+        with self._cond:
+            session.queue.append(item)
+            if not session.scheduled:
+                session.scheduled = True
+                self._sessions.append(session)
+
+            if self._idle:
+                self._cond.notify()
+            elif len(self._threads) < self.max_workers:
+                t = threading.Thread(
+                    target=self._worker,
+                    name=f'formula-worker-{len(self._threads)}',
+                    daemon=True
+                )
+                self._threads.append(t)
+                t.start()
+
+    def _next(self):
+        for _ in range(len(self._sessions)):
+            session = self._sessions.popleft()
+            if session.running < session.limit:
+                item = session.queue.popleft()
+                session.running += 1
+                if session.queue:
+                    # back of the line
+                    self._sessions.append(session)
+                else:
+                    session.scheduled = False
+                return session, item
+            # at its limit: let the others pass
+            self._sessions.append(session)
+
+    def _worker(self):
+        _local.worker = True
+        while True:
+            with self._cond:
+                work = self._next()
+                while work is None:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    work = self._next()
+
+            session, item = work
+            item.run()
+
+            with self._cond:
+                session.running -= 1
+                if session.queue:
+                    # it may have been held back by its limit
+                    self._cond.notify()
+
+
+# snapshot connections
+
+_checkoutlock = threading.Lock()
+
+
+def pool_exhausted(engine):
+    "would a connection checkout from the engine pool have to wait ?"
+    pool = engine.pool
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return False
+    return pool.checkedout() >= pool.size() + pool._max_overflow
+
+
+class SnapshotConnections:
+    """A bounded set of connections, all reading the snapshot of a
+    request transaction.
+
+    A thread borrows one of them for the duration of a fetch (nested
+    borrows from the same thread get the same connection).
+    """
+
+    def __init__(self, engine, snapshot, size, fallback=None):
+        self.engine = engine
+        self.snapshot = snapshot
+        # the request thread may hold one while waiting for the
+        # workers: they must have at least another one
+        self.size = max(2, size)
+        # the request connection, used when the engine pool is exhausted
+        self.fallback = fallback
+        self.cns = []
+        self.free = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.count = 0
+
+    @classmethod
+    def export(cls, cn, size):
+        # a snapshot only lives as long as its transaction
+        if isinstance(cn, Engine):
+            return None
+        # postgres cannot export a snapshot from a subtransaction
+        if cn.in_nested_transaction():
+            return None
+        # no connection to spare
+        if pool_exhausted(cn.engine):
+            return None
+        # the writes of the request transaction would not be seen
+        # from the exported snapshot
+        if cn.execute('select txid_current_if_assigned()').scalar() is not None:
+            return None
+        snapshot = cn.execute('select pg_export_snapshot()').scalar()
+        return cls(cn.engine, snapshot, size, fallback=cn)
+
+    @staticmethod
+    def current():
+        "the snapshot connections the current thread is borrowing from"
+        held = getattr(_local, 'held', None)
+        if held is not None:
+            return held[0]
+
+    def _connect(self):
+        # we must not wait for a connection: concurrent requests
+        # could exhaust the engine pool
+        with _checkoutlock:
+            if pool_exhausted(self.engine):
+                return None
+            cn = self.engine.connect()
+        try:
+            cn.begin()
+            cn.execute(
+                'set transaction isolation level repeatable read, read only'
+            )
+            cn.execute(f"set transaction snapshot '{self.snapshot}'")
+        except Exception:
+            cn.close()
+            raise
+        with self.lock:
+            self.cns.append(cn)
+        return cn
+
+    def _acquire(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            grow = self.count < self.size
+            if grow:
+                self.count += 1
+        if not grow:
+            return self.free.get()
+
+        try:
+            cn = self._connect()
+        except Exception:
+            with self.lock:
+                self.count -= 1
+            raise
+        if cn is None:
+            with self.lock:
+                self.count -= 1
+            if self.fallback is None:
+                raise RuntimeError('no connection available')
+            # degrade to the request connection (and its view)
+            return self.fallback
+        return cn
+
+    @contextmanager
+    def connection(self):
+        held = getattr(_local, 'held', None)
+        if held is not None:
+            assert held[0] is self
+            held[2] += 1
+            try:
+                yield held[1]
+            finally:
+                held[2] -= 1
+            return
+
+        cn = self._acquire()
+        _local.held = [self, cn, 1]
+        try:
+            yield cn
+        finally:
+            _local.held = None
+            if cn is not self.fallback:
+                self.free.put(cn)
+
+    def close(self):
+        for cn in self.cns:
+            cn.close()
+        self.cns = []
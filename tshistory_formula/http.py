@@ -34,6 +34,14 @@ formula_components.add_argument(
     help='return the recursively expanded formula components'
 )
 
+dependents = base.copy()
+dependents.add_argument(
+    'transitive',
+    type=inputs.boolean,
+    default=True,
+    help='also return the formulas depending on the direct dependents'
+)
+
 register_formula = base.copy()
 register_formula.add_argument(
     'text',
@@ -162,6 +170,19 @@ class formula_httpapi(httpapi):
                 form = tsa.formula_components(args.name, args.expanded)
                 return form, 200
 
+        @nss.route('/dependents')
+        class timeseries_dependents(Resource):
+
+            @api.expect(dependents)
+            @onerror
+            def get(self):
+                args = dependents.parse_args()
+
+                if not tsa.exists(args.name):
+                    api.abort(404, f'`{args.name}` does not exists')
+
+                return tsa.dependents(args.name, args.transitive), 200
+
         @nsg.route('/formula')
         class group_formula(Resource):
 
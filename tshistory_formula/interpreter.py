@@ -1,17 +1,23 @@
 import json
 import inspect
+import threading
+from contextlib import contextmanager
 from functools import partial
 from datetime import datetime
 
+import numpy as np
 import pytz
 import pandas as pd
 from psyl.lisp import (
     Env,
-    parse
+    parse,
+    serialize
 )
 
 from tshistory.util import empty_series
 from tshistory_formula.evaluator import (
+    Plan,
+    pcompile,
     pevaluate,
     pexpreval,
     quasiexpreval
@@ -35,8 +41,21 @@ def jsontypes():
 
 
 class Interpreter:
-    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'vcache', 'auto')
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'vcache', 'auto',
+                 'snapshot', 'prefetched')
     FUNCS = None
+    # size of the process-wide pool running the auto operators
+    # (must be set before the first evaluation)
+    poolsize = 32
+    # how many auto operators of one evaluation may run at once
+    concurrency = 16
+    # how many connections (reading the request snapshot) the
+    # workers of one evaluation may use
+    connections = 8
+    # fetch the series leaves in bulk before evaluating
+    prefetching = True
+    _pool = None
+    _poollock = threading.Lock()
 
     @property
     def operators(self):
@@ -44,6 +63,14 @@ class Interpreter:
             Interpreter.FUNCS = registry.FUNCS
         return Interpreter.FUNCS
 
+    @classmethod
+    def workerpool(cls):
+        if Interpreter._pool is None:
+            with Interpreter._poollock:
+                if Interpreter._pool is None:
+                    Interpreter._pool = helper.WorkerPool(cls.poolsize)
+        return Interpreter._pool
+
     def __init__(self, cn, tsh, getargs):
         self.cn = cn
         self.tsh = tsh
@@ -59,16 +86,85 @@ class Interpreter:
         self.env = Env(funcs)
         self.histories = {}
         self.vcache = {}
-        self.auto = set(registry.AUTO.values())
+        self.auto = set(registry.AUTO)
+        self.snapshot = None
+        self.prefetched = None
+
+    @contextmanager
+    def connection(self):
+        "the connection to fetch with from the current thread"
+        if self.snapshot is None:
+            yield self.cn
+            return
+
+        with self.snapshot.connection() as cn:
+            yield cn
 
     def get(self, name, getargs):
         # `getarg` likey comes from self.getargs
         # but we allow it being modified hence
         # it comes back as a parameter there
-        return self.tsh.get(self.cn, name, **getargs)
+        if self.prefetched and getargs == self.prefetched[0]:
+            ts = self.prefetched[1].get(name)
+            if ts is not None:
+                return ts
+
+        with self.connection() as cn:
+            return self.tsh.get(cn, name, **getargs)
+
+    def prefetch(self, plan):
+        """Fetch in one go the primary series leaves of a plan having
+        a literal name, and return how many auto operators remain to
+        be fetched on their own (by the worker pool).
+        """
+        fetches = [step for step in plan.steps if step.op in self.auto]
+        names = {
+            step.args[0] for step in fetches
+            if step.op == 'series' and isinstance(step.args[0], str)
+        }
+        if not self.prefetching or len(names) < 2 or not set(self.getargs).issubset(
+                ('revision_date', 'from_value_date', 'to_value_date')):
+            return len(fetches)
+
+        with self.connection() as cn:
+            series = self.tsh._get_many(cn, names, **self.getargs)
+        self.prefetched = (dict(self.getargs), series)
+        return len(fetches) - sum(
+            1 for step in fetches
+            if step.op == 'series' and step.args[0] in series
+        )
 
     def evaluate(self, tree):
-        return pevaluate(tree, self.env, self.auto)
+        plan = tree if isinstance(tree, Plan) else pcompile(tree)
+        if self.snapshot is not None or self.prefetched is not None:
+            # nested evaluation
+            return self._evaluate(plan)
+
+        # borrowed from an enclosing evaluation ?
+        self.snapshot = helper.SnapshotConnections.current()
+        owned = None
+        try:
+            fetches = self.prefetch(plan)
+            if (self.snapshot is None and
+                fetches > 1 and
+                not helper.inworker()):
+                # let the workers read in parallel what the request sees
+                owned = self.snapshot = helper.SnapshotConnections.export(
+                    self.cn, self.connections
+                )
+            return self._evaluate(plan)
+        finally:
+            if owned is not None:
+                owned.close()
+            self.snapshot = None
+            self.prefetched = None
+
+    def _evaluate(self, plan):
+        return pevaluate(
+            plan, self.env, self.auto,
+            concurrency=self.concurrency,
+            pool=self.workerpool()
+        )
 
     def today(self, naive, tz):
         if naive:
@@ -119,24 +215,74 @@ class OperatorHistory(Interpreter):
 
 
 class HistoryInterpreter(Interpreter):
-    __slots__ = 'env', 'cn', 'tsh', 'getargs', 'histories', 'tzaware', 'namecache', 'vcache'
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'tzaware', 'namecache', 'vcache',
+                 'window', 'idates')
 
     def __init__(self, name, *args, histories):
         super().__init__(*args)
         self.histories = histories
         # a callsite -> name mapping
         self.namecache = {}
-        self.tzaware = self.tsh.metadata(self.cn, name)
+        meta = self.tsh.metadata(self.cn, name) or {}
+        self.tzaware = meta.get('tzaware', False)
+        # when set, the value dates the series are restricted to
+        self.window = None
+        # name -> (history, sorted utc idates, series, cursor)
+        self.idates = {}
+
+    def fork(self):
+        """A sibling interpreter for another thread: it shares the
+        (read-only) histories but has its own environment.
+        """
+        other = type(self).__new__(type(self))
+        Interpreter.__init__(other, self.cn, self.tsh, dict(self.getargs))
+        other.histories = self.histories
+        other.namecache = self.namecache
+        other.tzaware = self.tzaware
+        other.window = None
+        other.idates = {}
+        other.snapshot = self.snapshot
+        return other
+
+    @staticmethod
+    def _stamp(idate):
+        # naive dates are taken as utc
+        return pd.Timestamp(idate).value
+
+    def _idate_index(self, name):
+        hist = self.histories[name]
+        index = self.idates.get(name)
+        # the histories can be updated after construction
+        if index is None or index[0] is not hist:
+            stamps = np.array(
+                [self._stamp(idate) for idate in hist],
+                dtype='int64'
+            )
+            order = np.argsort(stamps, kind='stable')
+            values = list(hist.values())
+            stamps = stamps[order]
+            series = [values[idx] for idx in order]
+            index = [hist, stamps, series, -1]
+            self.idates[name] = index
+        return index
 
     def _find_by_nearest_idate(self, name, idate):
-        hist = self.histories[name]
-        tzaware = idate.tzinfo is not None
-        for date in reversed(list(hist.keys())):
-            compdate = date
-            if not tzaware:
-                compdate = date.replace(tzinfo=None)
-            if idate >= compdate:
-                return hist[date]
+        index = self._idate_index(name)
+        _hist, stamps, series, cursor = index
+        stamp = self._stamp(idate)
+        # the insertion dates are mostly visited in order: try the
+        # current position and the next one before bisecting
+        for pos in (cursor, cursor + 1):
+            if (0 <= pos < len(stamps) and
+                stamps[pos] <= stamp and
+                (pos + 1 == len(stamps) or stamp < stamps[pos + 1])):
+                break
+        else:
+            pos = int(np.searchsorted(stamps, stamp, side='right')) - 1
+
+        if pos >= 0:
+            index[3] = pos
+            return series[pos]
 
         ts = empty_series(
             self.tzaware,
@@ -153,7 +299,10 @@ class HistoryInterpreter(Interpreter):
         # get the nearest inferior or equal for the given
         # insertion date
         assert self.histories
-        return self._find_by_nearest_idate(name, idate)
+        ts = self._find_by_nearest_idate(name, idate)
+        if self.window is not None:
+            ts = ts.loc[ts.index.intersection(self.window)]
+        return ts
 
     def get_auto(self, tree):
         """ helper for autotrophic series that have pre built their
@@ -171,7 +320,15 @@ class HistoryInterpreter(Interpreter):
     def evaluate(self, tree, idate, name):
         self.env['__idate__'] = idate
         self.env['__name__'] = name
-        ts = pevaluate(tree, self.env, self.auto, hist=True)
+        # bind .today before any operator runs (the auto operators
+        # calling .get may not have been scheduled yet)
+        self.getargs['revision_date'] = idate
+        ts = pevaluate(
+            tree, self.env, self.auto,
+            concurrency=self.concurrency,
+            hist=True,
+            pool=self.workerpool()
+        )
         ts.name = name
         return ts
 
@@ -179,44 +336,85 @@ class HistoryInterpreter(Interpreter):
 # staircase fast path
 
 
-def has_compatible_operators(cn, tsh, tree, good_operators):
-    operators = [tree[0]]
-    for param in tree[1:]:
-        if isinstance(param, list):
-            operators.append(param[0])
-    if any(op not in good_operators
-           for op in operators):
-        return False
+def staircase_operator(op, good_operators=()):
+    "does the operator commute with the staircase transformation ?"
+    if op in good_operators:
+        return True
+    return getattr(registry.FUNCS.get(op), 'staircase', False)
+
+
+def pointwise_operator(op, good_operators=()):
+    "does the operator output at a value date only depend on its inputs at this date ?"
+    if op in good_operators:
+        return True
+    return getattr(registry.FUNCS.get(op), 'pointwise', False)
 
-    names = tsh.find_series(cn, tree)
-    for name in names:
-        formula = tsh.formula(cn, name)
-        if formula:
-            tree = parse(formula)
-            if not has_compatible_operators(
-                    cn, tsh, tree, good_operators):
-                return False
 
+def _replacing_clip(tree):
+    """a clip replacing its out of bounds values (rather than dropping
+    them) commutes with the staircase transformation
+    """
+    kw = dict(zip(tree[2::2], tree[3::2]))
+    return all(
+        kw.get(bound) is None or kw.get(f'replace{bound}') is True
+        for bound in ('min', 'max')
+    )
+
+
+def _callsites(tree, op):
+    if tree[0] == op:
+        yield tree
+    for item in tree[1:]:
+        if isinstance(item, list):
+            yield from _callsites(item, op)
+
+
+def staircase_tree(expanded, good_operators=()):
+    "do all the operators of an expanded tree entry commute with the staircase ?"
+    for op in expanded.operators:
+        if staircase_operator(op, good_operators):
+            continue
+        if op == 'clip' and all(
+                _replacing_clip(site)
+                for site in _callsites(expanded.tree, 'clip')):
+            continue
+        return False
     return True
 
 
+def has_compatible_operators(cn, tsh, tree, good_operators):
+    return staircase_tree(
+        tsh._expanded(cn, serialize(tree)),
+        good_operators
+    )
+
+
 class FastStaircaseInterpreter(Interpreter):
-    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'delta')
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'delta', 'staircases')
+    # we read staircases, not series
+    prefetching = False
 
-    def __init__(self, cn, tsh, getargs, delta):
+    def __init__(self, cn, tsh, getargs, delta, staircases=None):
         assert delta is not None
         super().__init__(cn, tsh, getargs)
         self.delta = delta
+        # precomputed name -> staircase mapping (for our getargs)
+        self.staircases = staircases or {}
 
     def get(self, name, getargs):
-        if self.tsh.type(self.cn, name) == 'primary':
-            return self.tsh.staircase(
-                self.cn, name, delta=self.delta, **getargs
+        ts = self.staircases.get(name)
+        if ts is not None and getargs == self.getargs:
+            return ts
+
+        with self.connection() as cn:
+            if self.tsh.type(cn, name) == 'primary':
+                return self.tsh.staircase(
+                    cn, name, delta=self.delta, **getargs
+                )
+            return self.tsh.get(
+                cn, name, **getargs,
+                __interpreter__=self
             )
-        return self.tsh.get(
-            self.cn, name, **getargs,
-            __interpreter__=self
-        )
 
 
 class NullIntepreter(Interpreter):
@@ -1,3 +1,4 @@
+from collections.abc import Mapping
 from warnings import warn
 
 import pandas as pd
@@ -20,7 +21,21 @@ def _ensure_options(obj):
     return obj
 
 
-def func(name, auto=False):
+def func(name, auto=False, staircase=False, pointwise=False):
+    """Register an operator.
+
+    `auto` marks the operators producing series by themselves.
+
+    `staircase` declares that the operator commutes with the staircase
+    transformation: applied to the staircases of its inputs, it yields
+    the staircase of its output (e.g. `slice`). The staircase of
+    formulas built with it can then take the fast path.
+
+    `pointwise` declares that the output of the operator at a value
+    date only depends on its inputs at this same date (e.g. `clip`,
+    which drops or bounds each point on its own). The history of
+    formulas built with it can then be computed incrementally.
+    """
     # work around the circular import
     from tshistory_formula.helper import assert_typed
     from tshistory_formula.interpreter import Interpreter
@@ -49,6 +64,11 @@ def func(name, auto=False):
             )
 
         dec = decorate(func, operator, extrakw={'__tree__': None})
+        # operator identity, resolved once for the evaluator
+        dec.opname = name
+        dec.auto = auto
+        dec.staircase = staircase
+        dec.pointwise = pointwise
 
         FUNCS[name] = dec
         if auto:
@@ -68,6 +88,42 @@ def history(name):
     return decorator
 
 
+class lazyhistory(Mapping):
+    """An insertion date -> series mapping whose versions are only
+    computed (once) when accessed.
+
+    A `history` implementation can return one to make the insertion
+    dates of its operator cheap (when it does not provide an
+    `insertion_dates` implementation).
+
+    e.g. `return lazyhistory(idates, lambda idate: fetch(idate))`
+    """
+    __slots__ = ('_idates', '_known', '_getversion', '_versions')
+
+    def __init__(self, idates, getversion):
+        self._idates = sorted(idates)
+        self._known = set(self._idates)
+        self._getversion = getversion
+        self._versions = {}
+
+    def __getitem__(self, idate):
+        ts = self._versions.get(idate)
+        if ts is None:
+            if idate not in self._known:
+                raise KeyError(idate)
+            ts = self._versions[idate] = self._getversion(idate)
+        return ts
+
+    def __iter__(self):
+        return iter(self._idates)
+
+    def __len__(self):
+        return len(self._idates)
+
+    def __contains__(self, idate):
+        return idate in self._known
+
+
 def insertion_dates(name):
 
     def decorator(func):
@@ -7,6 +7,36 @@ create table "{ns}".formula (
 
 create unique index "ix_{ns}_formula_name" on "{ns}".formula (name);
 
+-- bumped on each change of the formula table
+-- (allows processes to keep their formula cache coherent)
+create table "{ns}".formula_version (
+  version bigint not null
+);
+
+insert into "{ns}".formula_version (version) values (0);
+
+-- formula -> referenced series names and operators
+create table "{ns}".formula_dependency (
+  id serial primary key,
+  name text not null references "{ns}".formula (name)
+       on delete cascade on update cascade,
+  kind text not null, -- series or operator
+  ref text not null,
+  unique (name, kind, ref)
+);
+
+create index "ix_{ns}_formula_dependency_ref" on "{ns}".formula_dependency (ref);
+
+-- last version of the materialized formulas
+-- (generation is bumped each time it becomes stale)
+create table "{ns}".formula_materialized (
+  name text primary key references "{ns}".formula (name)
+       on delete cascade on update cascade,
+  series bytea,
+  stale bool not null default true,
+  generation bigint not null default 0
+);
+
 create table "{ns}".group_formula (
   id serial primary key,
   -- name will have an index (unique), sufficient for the query needs
@@ -1,14 +1,26 @@
 from collections import defaultdict
 from datetime import timedelta
+from time import time
 import itertools
 import json
+import zlib
 
+import numpy as np
 import pandas as pd
 from psyl.lisp import parse, serialize
 from tshistory.tsio import timeseries as basets
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
 from tshistory.util import (
-    diff,
-    tx
+    binary_unpack,
+    compatible_date,
+    empty_series,
+    numpy_deserialize,
+    pack_series,
+    series_metadata,
+    tx,
+    unpack_series
 )
 
 from tshistory_formula import funcs, gfuncs  # trigger registration
@@ -17,7 +29,9 @@ from tshistory_formula import (
     interpreter,
     helper
 )
+from tshistory_formula.evaluator import pcompile
 from tshistory_formula.registry import (
+    AUTO,
     FINDERS,
     FUNCS,
     HISTORY,
@@ -26,9 +40,175 @@ from tshistory_formula.registry import (
 )
 
 
+class formulacache:
+    """Holds the formula texts (and the names of the materialized
+    formulas) of a namespace, as of a given version of the
+    `formula_version` counter.
+    """
+    __slots__ = ('version', 'texts', 'materialized', 'checked')
+
+    def __init__(self, version, texts, materialized):
+        self.version = version
+        self.texts = texts
+        self.materialized = materialized
+        self.checked = time()
+
+
+class expandedentry:
+    """An expanded formula tree (and its constant-folded version,
+    evaluation plan and operator names) along with the formula texts it
+    was built from.
+    """
+    __slots__ = ('deps', 'tree', 'folded', 'plan', 'operators')
+
+    def __init__(self, deps, tree):
+        self.deps = deps
+        self.tree = tree
+        self.folded = helper.constant_fold(tree)
+        self.plan = pcompile(self.folded)
+        self.operators = frozenset(_operators(tree))
+
+
+def _operators(tree):
+    yield tree[0]
+    for item in tree[1:]:
+        if isinstance(item, list):
+            yield from _operators(item)
+
+
+def changed_dates(old, new):
+    "the value dates where two versions of a series differ"
+    if old is None or not len(old):
+        return new.index
+    index = old.index.union(new.index)
+    old = old.reindex(index)
+    new = new.reindex(index)
+    same = (old == new) | (old.isnull() & new.isnull())
+    return index[~same.values]
+
+
+def diff_versions(base, other, precision=1e-14):
+    """The points of a version which are new or updated with respect to
+    the previous one (like `tshistory.util.diff`, with positional
+    lookups).
+    """
+    if base is None:
+        return other
+    base = base.dropna()
+    if not len(base):
+        return other
+
+    positions = base.index.get_indexer(other.index)
+    overlap = positions >= 0
+    basevalues = base.values[positions[overlap]]
+    othervalues = other.values[overlap]
+    if base.dtype == 'float64' and other.dtype == 'float64':
+        equal = np.isclose(basevalues, othervalues, rtol=0, atol=precision)
+    else:
+        equal = basevalues == othervalues
+
+    keep = other.notnull().values
+    keep[overlap] = ~equal
+    ts = other[keep]
+    if not ts.index.is_monotonic_increasing:
+        ts = ts.sort_index()
+    return ts
+
+
+def history_staircases(hist, deltas, maxdate, tzaware, name):
+    """Compute the staircases of a history for several deltas at once,
+    with the semantics of `tshistory.tsio.historycache.staircase` (the
+    history being bounded by `maxdate - delta` for each delta).
+
+    Return a delta -> series mapping.
+    """
+    out = {
+        delta: empty_series(tzaware, name=name)
+        for delta in deltas
+    }
+    stamps = np.array(
+        [pd.Timestamp(idate).value for idate in hist],
+        dtype='int64'
+    )
+    versions = list(hist.values())
+
+    # the value dates of each staircase: those of the last version
+    # inserted before its bound
+    domains = {}
+    for delta in deltas:
+        last = np.searchsorted(
+            stamps, pd.Timestamp(maxdate - delta).value, side='right'
+        ) - 1
+        if last >= 0:
+            domain = versions[last].dropna()
+            if len(domain):
+                domains[delta] = domain
+    if not domains:
+        return out
+
+    # all the points of all the versions, sorted by value date and
+    # version number, keyed by (value date rank, version number)
+    lengths = [len(ts) for ts in versions]
+    vnums = np.repeat(np.arange(len(versions)), lengths)
+    vdates = np.concatenate([ts.index.asi8 for ts in versions])
+    values = np.concatenate([ts.values for ts in versions])
+    order = np.lexsort((vnums, vdates))
+    values = values[order]
+    uniquedates = np.unique(vdates)
+    keys = (
+        np.searchsorted(uniquedates, vdates[order]) * len(versions) +
+        vnums[order]
+    )
+
+    for delta, domain in domains.items():
+        dates = domain.index.asi8
+        # the version seen `delta` before each value date
+        vnum = np.searchsorted(
+            stamps, dates - pd.Timedelta(delta).value, side='right'
+        ) - 1
+        targets = np.searchsorted(uniquedates, dates) * len(versions) + vnum
+        pos = np.searchsorted(keys, targets).clip(0, len(keys) - 1)
+        found = (vnum >= 0) & (keys[pos] == targets)
+        found[found] = pd.notnull(values[pos[found]])
+        out[delta] = pd.Series(
+            values[pos[found]],
+            index=domain.index[found],
+            dtype=domain.dtype,
+            name=name
+        )
+    return out
+
+
 class timeseries(basets):
+    # operators taking the staircase fast path, on top of those
+    # registered with `staircase=True`
     fast_staircase_operators = set(['+', '*', 'series', 'add', 'priority'])
+    # operators whose output at a value date only depends on their
+    # inputs at this date, on top of those registered with
+    # `pointwise=True`
+    pointwise_operators = set()
+    # how many threads may evaluate (contiguous ranges of) the
+    # insertion dates of a formula history
+    history_workers = 1
     metadata_compat_excluded = ()
+    # process-wide (dburi, namespace) -> formulacache mapping
+    _formula_caches = {}
+    # process-wide (dburi, namespace) -> count of the committed
+    # formula changes
+    _formula_generations = {}
+    # how long (in seconds) we trust the cache before checking
+    # the version counter again
+    formula_cache_ttl = 1
+    # process-wide (formula text, stopnames) -> expandedentry mapping
+    _expanded_cache = {}
+    expanded_cache_size = 10000
+    # process-wide autotrophic callsite -> (timestamp, idates) mapping
+    _auto_idates_cache = {}
+    auto_idates_cache_size = 1000
+    # how long (in seconds) the insertion dates of an autotrophic
+    # callsite are kept: the revisions made meanwhile are not seen
+    # (0, the default, disables the cache)
+    auto_idates_ttl = 0
 
     def find_series(self, cn, tree):
         op = tree[0]
@@ -165,6 +345,9 @@ class timeseries(basets):
             name=name,
             text=formula
         )
+        self._register_dependencies(cn, name, tree)
+        self._materialized_stale(cn, name)
+        self._formula_changed(cn)
 
         # save metadata
         if tzaware is None:
@@ -176,6 +359,95 @@ class timeseries(basets):
         meta = dict(meta, **coremeta)
         self.update_metadata(cn, name, meta, internal=True)
 
+    def _register_dependencies(self, cn, name, tree):
+        cn.execute(
+            f'delete from "{self.namespace}".formula_dependency '
+            'where name = %(name)s',
+            name=name
+        )
+        deps = [
+            {'name': name, 'kind': 'series', 'ref': ref}
+            for ref in self.find_series(cn, tree)
+        ] + [
+            {'name': name, 'kind': 'operator', 'ref': op}
+            for op in self.find_operators(cn, tree)
+        ]
+        cn.execute(
+            f'insert into "{self.namespace}".formula_dependency '
+            '(name, kind, ref) '
+            'values (%(name)s, %(kind)s, %(ref)s)',
+            deps
+        )
+
+    @tx
+    def dependencies(self, cn, name, transitive=False):
+        """Return a formula name -> [(series name, type)] mapping from the
+        dependency index, where type is `formula`, `primary` or None
+        (unknown here).
+
+        If `transitive`, the local formulas the given formula
+        depends upon are also part of the mapping.
+        """
+        ns = self.namespace
+        recursive = ''
+        if transitive:
+            recursive = (
+                'union '
+                'select dep.id, dep.name, dep.ref '
+                f'from "{ns}".formula_dependency as dep '
+                'join deps on dep.name = deps.ref '
+                "where dep.kind = 'series'"
+            )
+        res = cn.execute(
+            'with recursive deps as ('
+            ' select id, name, ref '
+            f' from "{ns}".formula_dependency '
+            " where name = %(name)s and kind = 'series' "
+            f' {recursive}'
+            ') '
+            'select deps.name, deps.ref, '
+            "       case when f.name is not null then 'formula' "
+            "            when r.seriesname is not null then 'primary' "
+            '       end '
+            'from deps '
+            f'left join "{ns}".formula as f on f.name = deps.ref '
+            f'left join "{ns}".registry as r on r.seriesname = deps.ref '
+            'order by deps.id',
+            name=name
+        )
+        deps = defaultdict(list)
+        for fname, ref, reftype in res.fetchall():
+            deps[fname].append((ref, reftype))
+        return dict(deps)
+
+    @tx
+    def dependents(self, cn, name, transitive=True):
+        """Return the names of the formulas referencing the given name
+        (and, if `transitive`, of the formulas referencing those).
+        """
+        ns = self.namespace
+        recursive = ''
+        if transitive:
+            recursive = (
+                'union '
+                'select dep.name '
+                f'from "{ns}".formula_dependency as dep '
+                'join deps on dep.ref = deps.name '
+                "where dep.kind = 'series'"
+            )
+        return [
+            fname for fname, in cn.execute(
+                'with recursive deps as ('
+                ' select name '
+                f' from "{ns}".formula_dependency '
+                " where ref = %(name)s and kind = 'series' "
+                f' {recursive}'
+                ') '
+                'select name from deps order by name',
+                name=name
+            ).fetchall()
+        ]
+
     def default_meta(self, tzaware):
         if tzaware:
             return {
@@ -194,11 +466,84 @@ class timeseries(basets):
         }
 
     def formula(self, cn, name):
-        formula = cn.execute(
-            f'select text from "{self.namespace}".formula where name = %(name)s',
-            name=name
+        if getattr(cn, '_formula_changed', False):
+            # the transaction has pending changes: the cache
+            # cannot be trusted there
+            return cn.execute(
+                f'select text from "{self.namespace}".formula '
+                'where name = %(name)s',
+                name=name
+            ).scalar()
+
+        return self._formula_cache(cn).texts.get(name)
+
+    def _formula_cache(self, cn):
+        key = (str(cn.engine.url), self.namespace)
+        cache = self._formula_caches.get(key)
+        if cache is not None and time() - cache.checked < self.formula_cache_ttl:
+            return cache
+
+        # a change committed by this process while we read must not
+        # be hidden by a cache built from the state before it
+        generation = self._formula_generations.get(key, 0)
+        # the version must be read before the texts, otherwise
+        # we could stamp a stale content with a fresh version
+        version = cn.execute(
+            f'select version from "{self.namespace}".formula_version'
         ).scalar()
-        return formula
+        if cache is not None and cache.version == version:
+            cache.checked = time()
+            return cache
+
+        texts = dict(
+            cn.execute(
+                f'select name, text from "{self.namespace}".formula'
+            ).fetchall()
+        )
+        materialized = frozenset(
+            name for name, in cn.execute(
+                f'select name from "{self.namespace}".formula_materialized'
+            ).fetchall()
+        )
+        cache = formulacache(version, texts, materialized)
+        if self._formula_generations.get(key, 0) == generation:
+            self._formula_caches[key] = cache
+        return cache
+
+    def _formula_changed(self, cn):
+        """Bump the formula version counter and drop the local cache.
+
+        Must be called after any write to the formula names or texts.
+        """
+        cn.execute(
+            f'update "{self.namespace}".formula_version '
+            'set version = version + 1'
+        )
+        key = (str(cn.engine.url), self.namespace)
+        if getattr(cn, '_formula_changed', None) is None:
+            # first change on this connection
+
+            def committed(cn):
+                # other connections may have cached the state
+                # preceding our changes in the meantime
+                for key in cn._formula_changed:
+                    self._formula_generations[key] = (
+                        self._formula_generations.get(key, 0) + 1
+                    )
+                    self._formula_caches.pop(key, None)
+                cn._formula_changed = set()
+
+            def rolledback(cn):
+                cn._formula_changed = set()
+
+            event.listen(cn, 'commit', committed)
+            event.listen(cn, 'rollback', rolledback)
+            cn._formula_changed = set()
+
+        # until the end of the transaction, reads must be done
+        # from the database
+        cn._formula_changed.add(key)
+        self._formula_caches.pop(key, None)
 
     def list_series(self, cn):
         series = super().list_series(cn)
@@ -218,17 +563,40 @@ class timeseries(basets):
     def exists(self, cn, name):
         return super().exists(cn, name) or bool(self.formula(cn, name))
 
+    @tx
     def update(self, cn, updatets, name, author, **k):
         if self.type(cn, name) == 'formula':
             raise ValueError(f'`{name}` is a formula, it cannot be updated')
 
-        return super().update(cn, updatets, name, author, **k)
+        tsdiff = super().update(cn, updatets, name, author, **k)
+        if tsdiff is not None and len(tsdiff):
+            self._materialized_stale(cn, name)
+        return tsdiff
+
+    @tx
+    def replace(self, cn, newts, name, author, **k):
+        tsdiff = super().replace(cn, newts, name, author, **k)
+        if tsdiff is not None and len(tsdiff):
+            self._materialized_stale(cn, name)
+        return tsdiff
+
+    @tx
+    def strip(self, cn, name, csid):
+        super().strip(cn, name, csid)
+        self._materialized_stale(cn, name)
 
     @tx
     def get(self, cn, name, **kw):
         formula = self.formula(cn, name)
         if formula:
-            ts = self.eval_formula(cn, formula, **kw)
+            if (kw.get('revision_date') is None and
+                set(kw).issubset(
+                    ('revision_date', 'from_value_date', 'to_value_date')
+                ) and
+                self._is_materialized(cn, name)):
+                ts = self._get_materialized(cn, name, formula, **kw)
+            else:
+                ts = self.eval_formula(cn, formula, **kw)
             if ts is not None:
                 ts.name = name
             return ts
@@ -241,24 +609,349 @@ class timeseries(basets):
 
         return ts
 
+    # materialized formulas
+
+    @tx
+    def materialize(self, cn, name, materialized=True):
+        """Flag (or unflag) a formula as materialized: its last version
+        is then stored and served by `.get` (when no revision date is
+        asked), and recomputed when one of its components changes.
+
+        Only the formulas built from local series can be materialized:
+        the autotrophic operators, series from other sources or
+        `today` would change its value without marking it stale.
+        """
+        if self.type(cn, name) != 'formula':
+            raise ValueError(f'`{name}` is not a formula')
+
+        if materialized:
+            self._check_materializable(cn, name)
+            cn.execute(
+                f'insert into "{self.namespace}".formula_materialized (name) '
+                'values (%(name)s) '
+                'on conflict (name) do nothing',
+                name=name
+            )
+        else:
+            cn.execute(
+                f'delete from "{self.namespace}".formula_materialized '
+                'where name = %(name)s',
+                name=name
+            )
+        self._formula_changed(cn)
+
+    def _check_materializable(self, cn, name):
+        tree = self._expanded(cn, self.formula(cn, name))
+        volatile = sorted(
+            tree.operators & ((set(AUTO) - {'series'}) | {'today'})
+        )
+        if volatile:
+            raise ValueError(
+                f'`{name}` cannot be materialized: it uses '
+                f'`{volatile[0]}`'
+            )
+
+        for site in self.find_callsites(cn, 'series', tree.tree):
+            if not self.exists(cn, site[1]):
+                raise ValueError(
+                    f'`{name}` cannot be materialized: `{site[1]}` '
+                    'is not a local series'
+                )
+
+    def _is_materialized(self, cn, name):
+        if getattr(cn, '_formula_changed', False):
+            return cn.execute(
+                f'select 1 from "{self.namespace}".formula_materialized '
+                'where name = %(name)s',
+                name=name
+            ).scalar() is not None
+
+        return name in self._formula_cache(cn).materialized
+
+    def _get_materialized(self, cn, name, formula,
+                          revision_date=None,
+                          from_value_date=None,
+                          to_value_date=None):
+        row = cn.execute(
+            'select series, stale, generation '
+            f'from "{self.namespace}".formula_materialized '
+            'where name = %(name)s',
+            name=name
+        ).fetchone()
+        if row is None:
+            # unflagged in the meantime
+            return self.eval_formula(
+                cn, formula,
+                from_value_date=from_value_date,
+                to_value_date=to_value_date
+            )
+
+        packed, stale, generation = row
+        if packed is not None and not stale:
+            ts = unpack_series(name, packed)
+        else:
+            ts = self._refresh_materialized(cn, name, formula, generation)
+
+        if from_value_date or to_value_date:
+            tzaware = ts.index.tz is not None
+            ts = ts.loc[
+                from_value_date and compatible_date(tzaware, from_value_date):
+                to_value_date and compatible_date(tzaware, to_value_date)
+            ]
+        return ts
+
+    def _refresh_materialized(self, cn, name, formula, generation):
+        ts = self.eval_formula(cn, formula)
+        try:
+            with cn.begin_nested():
+                # a stale marking happening since we read `generation`
+                # means we might have computed an outdated value
+                cn.execute(
+                    f'update "{self.namespace}".formula_materialized '
+                    'set series = %(series)s, stale = false '
+                    'where name = %(name)s and generation = %(generation)s',
+                    series=pack_series(series_metadata(ts), ts),
+                    name=name,
+                    generation=generation
+                )
+        except DBAPIError:
+            # e.g. a read-only transaction: serve without storing
+            pass
+        return ts
+
+    @tx
+    def refresh_materialized(self, cn):
+        """Recompute the stale materialized formulas and return their
+        names.
+        """
+        stale = cn.execute(
+            'select name, generation '
+            f'from "{self.namespace}".formula_materialized '
+            'where stale or series is null '
+            'order by name'
+        ).fetchall()
+        for name, generation in stale:
+            self._refresh_materialized(
+                cn, name, self.formula(cn, name), generation
+            )
+        return [name for name, _ in stale]
+
+    def _materialized_stale(self, cn, name):
+        """Mark stale the materialized formulas depending on `name` (or
+        being it).
+        """
+        ns = self.namespace
+        # the common case: nothing is materialized
+        if not cn.execute(
+                f'select exists (select 1 from "{ns}".formula_materialized)'
+        ).scalar():
+            return
+
+        names = [
+            mname for mname, in cn.execute(
+                'with recursive deps as ('
+                ' select %(name)s::text as name '
+                ' union '
+                ' select dep.name '
+                f' from "{ns}".formula_dependency as dep '
+                ' join deps on dep.ref = deps.name '
+                " where dep.kind = 'series'"
+                ') '
+                'select mat.name '
+                f'from "{ns}".formula_materialized as mat '
+                'join deps on deps.name = mat.name',
+                name=name
+            ).fetchall()
+        ]
+        if not names:
+            return
+
+        cn.execute(
+            f'update "{ns}".formula_materialized '
+            'set stale = true, generation = generation + 1 '
+            'where name = any(%(names)s)',
+            names=names
+        )
+
+    @tx
+    def _get_many(self, cn, names,
+                  revision_date=None,
+                  from_value_date=None,
+                  to_value_date=None):
+        """Fetch a bunch of series sharing the same query bounds and
+        return a name -> series mapping.
+
+        Only the primary series found in the registry are read (with a
+        fixed number of queries, their heads being read in a single
+        statement): the formulas, other sources or unknown names are
+        left out of the mapping, for the caller to `.get` them.
+        """
+        self._guard_query_dates(
+            revision_date, from_value_date, to_value_date
+        )
+        names = sorted(set(names))
+        if not names:
+            return {}
+
+        ns = self.namespace
+        primaries = cn.execute(
+            f'select seriesname, tablename, metadata '
+            f'from "{ns}".registry '
+            f'where seriesname in %(names)s',
+            names=tuple(names)
+        ).fetchall()
+
+        out = {}
+        if not primaries:
+            return out
+
+        idatefilter = ''
+        if revision_date:
+            idatefilter = 'where insertion_date <= %(idate)s '
+        heads = {
+            idx: head
+            for idx, head in cn.execute(
+                ' union all '.join(
+                    f'select {idx} as idx, snapshot from ('
+                    f' select id, snapshot from "{ns}.revision"."{table}" '
+                    f' {idatefilter}'
+                    f' order by id desc limit 1'
+                    f') as head{idx}'
+                    for idx, (_, table, _) in enumerate(primaries)
+                ),
+                idate=revision_date
+            ).fetchall()
+        }
+
+        bounds = {}
+        for idx, (name, _, meta) in enumerate(primaries):
+            tzaware = meta['tzaware']
+            bounds[idx] = (
+                from_value_date and compatible_date(tzaware, from_value_date),
+                to_value_date and compatible_date(tzaware, to_value_date)
+            )
+
+        chunks = defaultdict(dict)
+        if heads:
+            ctes = []
+            for idx, head in heads.items():
+                table = f'"{ns}.snapshot"."{primaries[idx][1]}"'
+                where = ''
+                if bounds[idx][0]:
+                    where = f'where chunks.cend >= %(start{idx})s'
+                ctes.append(
+                    f'chunks{idx} as ('
+                    f' select chunks.id as cid, chunks.parent as parent,'
+                    f'        chunks.chunk as chunk'
+                    f' from {table} as chunks'
+                    f' where chunks.id = {head}'
+                    f' union'
+                    f' select chunks.id as cid, chunks.parent as parent,'
+                    f'        chunks.chunk as chunk'
+                    f' from {table} as chunks'
+                    f' join chunks{idx} on chunks.id = chunks{idx}.parent'
+                    f' {where}'
+                    f')'
+                )
+            sql = 'with recursive {} {}'.format(
+                ', '.join(ctes),
+                ' union all '.join(
+                    f'select {idx}, cid, parent, chunk from chunks{idx}'
+                    for idx in heads
+                )
+            )
+            for idx, cid, parent, chunk in cn.execute(
+                    sql,
+                    **{f'start{idx}': bounds[idx][0] for idx in heads}
+            ).fetchall():
+                chunks[idx][cid] = (parent, chunk)
+
+        for idx, (name, _, meta) in enumerate(primaries):
+            if idx not in heads:
+                out[name] = empty_series(
+                    meta['tzaware'],
+                    dtype=meta['value_type'],
+                    name=name
+                )
+                continue
+
+            # walk up from the head
+            rawchunks = []
+            cid = heads[idx]
+            while cid in chunks[idx]:
+                cid, chunk = chunks[idx][cid]
+                rawchunks.append(chunk)
+            rawchunks.reverse()
+
+            ts = self._chunks_to_ts(meta, rawchunks)
+            fromdate, todate = bounds[idx]
+            ts = ts.loc[fromdate:todate].dropna()
+            ts.name = name
+            out[name] = ts
+
+        return out
+
+    def _chunks_to_ts(self, meta, rawchunks):
+        indexchunks, valueschunks = list(zip(*(
+            binary_unpack(zlib.decompress(chunk))
+            for chunk in rawchunks
+        )))
+        bseparator = b'\0' if meta['value_type'] == 'object' else b''
+        index, values = numpy_deserialize(
+            b''.join(indexchunks),
+            bseparator.join(valueschunks),
+            meta
+        )
+        ts = pd.Series(values, index=index)
+        if meta['tzaware']:
+            ts = ts.tz_localize('UTC')
+        return ts
+
     def eval_formula(self, cn, formula, **kw):
         i = kw.get('__interpreter__') or interpreter.Interpreter(cn, self, kw)
         ts = i.evaluate(
-            self._expanded_formula(cn, formula)
+            self._expanded(cn, formula).plan
         )
         return ts
 
     def _expanded_formula(self, cn, formula, stopnames=()):
-        return helper.expanded(
-            self, cn, parse(formula), stopnames=stopnames
+        """Return the expanded tree of a formula (the constant folding
+        only happens in the evaluation plan).
+
+        The returned tree is shared: it must not be mutated.
+        """
+        return self._expanded(cn, formula, stopnames).tree
+
+    def _expanded(self, cn, formula, stopnames=()):
+        key = (formula, tuple(stopnames))
+        entry = self._expanded_cache.get(key)
+        if entry is not None:
+            # is any formula of the dependency closure changed ?
+            if all(
+                    self.formula(cn, name) == text
+                    for name, text in entry.deps.items()
+            ):
+                return entry
+
+        deps = {}
+        tree = helper.expanded(
+            self, cn, parse(formula), stopnames=key[1], deps=deps
         )
+        entry = expandedentry(deps, tree)
+        if len(self._expanded_cache) >= self.expanded_cache_size:
+            # evict the oldest entry
+            self._expanded_cache.pop(
+                next(iter(self._expanded_cache)), None
+            )
+        self._expanded_cache[key] = entry
+        return entry
 
     def expanded_formula(self, cn, name, stopnames=()):
         formula = self.formula(cn, name)
         if formula is None:
             return
 
-        tree = self._expanded_formula(cn, formula, stopnames)
+        tree = self._expanded(cn, formula, stopnames).tree
         if tree is None:
             return
 
@@ -266,6 +959,7 @@ class timeseries(basets):
 
     @tx
     def delete(self, cn, name):
+        self._materialized_stale(cn, name)
         if self.type(cn, name) != 'formula':
             return super().delete(cn, name)
 
@@ -274,6 +968,7 @@ class timeseries(basets):
             'where name = %(name)s',
             name=name
         )
+        self._formula_changed(cn)
 
     def _custom_history_sites(self, cn, tree):
         return [
@@ -340,8 +1035,103 @@ class timeseries(basets):
                 )
             return hist
 
+        plan, i, idates, histmap, incremental = self._history_setup(
+            cn, name,
+            from_insertion_date,
+            to_insertion_date,
+            from_value_date,
+            to_value_date
+        )
+        versions = self._evaluate_history(
+            cn, i, plan, name, idates, histmap, incremental
+        )
+
+        if diffmode:
+            return {
+                idate: ts
+                for idate, ts, _patch in self._diffmode(
+                    cn, name, versions,
+                    from_insertion_date, from_value_date, to_value_date
+                )
+            }
+
+        return {
+            idate: ts
+            for idate, ts, _patch in versions
+        }
+
+    def iterhistory(self, cn, name,
+                    from_insertion_date=None,
+                    to_insertion_date=None,
+                    from_value_date=None,
+                    to_value_date=None,
+                    diffmode=False,
+                    _keep_nans=False):
+        """Yield the (insertion date, version) pairs of a series
+        history. The versions of a formula are computed as they are
+        consumed: only the component histories are held in memory.
+        """
+        # the generator outlives the call: we can't use @tx
+        if isinstance(cn, Engine):
+            with cn.begin() as txcn:
+                yield from self.iterhistory(
+                    txcn, name,
+                    from_insertion_date,
+                    to_insertion_date,
+                    from_value_date,
+                    to_value_date,
+                    diffmode,
+                    _keep_nans
+                )
+            return
+
+        if not cn.in_transaction():
+            raise TypeError('You must use a transaction object')
+
+        if self.type(cn, name) != 'formula':
+            hist = self.history(
+                cn, name,
+                from_insertion_date,
+                to_insertion_date,
+                from_value_date,
+                to_value_date,
+                diffmode,
+                _keep_nans
+            )
+            if hist:
+                yield from hist.items()
+            return
+
+        plan, i, idates, histmap, incremental = self._history_setup(
+            cn, name,
+            from_insertion_date,
+            to_insertion_date,
+            from_value_date,
+            to_value_date
+        )
+        versions = self._iterevaluate(
+            i, plan, name, idates, histmap, incremental
+        )
+        if diffmode:
+            versions = self._diffmode(
+                cn, name, versions,
+                from_insertion_date, from_value_date, to_value_date
+            )
+        for idate, ts, _patch in versions:
+            yield idate, ts
+
+    def _history_setup(self, cn, name,
+                       from_insertion_date,
+                       to_insertion_date,
+                       from_value_date,
+                       to_value_date):
+        """Prepare the evaluation of a formula history: its plan, the
+        history interpreter holding the component histories and the
+        insertion dates to evaluate.
+        """
         formula = self.formula(cn, name)
-        tree = self._expanded_formula(cn, formula)
+        expanded = self._expanded(cn, formula)
+        tree = expanded.folded
         series = self.find_series(cn, tree)
 
         # normal history
@@ -366,20 +1156,33 @@ class timeseries(basets):
             ]
             if len(mins):
                 mindate = min(mins)
-                for name, hist in histmap.items():
-                    if mindate not in hist:
-                        ts_mindate = self.get(
-                            cn,
-                            name,
+                # the state of the incomplete ones, in one go
+                # for the primaries
+                incomplete = [
+                    sname for sname, hist in histmap.items()
+                    if mindate not in hist
+                ]
+                missing = self._get_many(
+                    cn,
+                    incomplete,
+                    revision_date=mindate,
+                    from_value_date=from_value_date,
+                    to_value_date=to_value_date
+                )
+                for sname in incomplete:
+                    if sname not in missing:
+                        missing[sname] = self.get(
+                            cn, sname,
                             revision_date=mindate,
                             from_value_date=from_value_date,
-                            to_value_date=to_value_date,
+                            to_value_date=to_value_date
                         )
-                        if ts_mindate is not None and len(ts_mindate):
-                            # the history must be ordered by key
-                            base = {mindate: ts_mindate}
-                            base.update(hist)
-                            histmap[name] = base
+                for sname, ts_mindate in missing.items():
+                    if ts_mindate is not None and len(ts_mindate):
+                        # the history must be ordered by key
+                        base = {mindate: ts_mindate}
+                        base.update(histmap[sname])
+                        histmap[sname] = base
 
         i = interpreter.HistoryInterpreter(
             name, cn, self, {
@@ -415,30 +1218,156 @@ class timeseries(basets):
             for hist in histmap.values()
             for idate in hist
         })
-        h = {
-            idate: i.evaluate(tree, idate, name)
-            for idate in idates
-        }
+        incremental = not callsites and self._pointwise(expanded.plan)
+        return expanded.plan, i, idates, histmap, incremental
 
-        if diffmode and idates:
-            iteridates = iter(idates)
-            firstidate = next(iteridates)
-            basets = self.get(
-                cn,
-                name,
-                from_value_date=from_value_date,
-                to_value_date=to_value_date,
-                revision_date=firstidate - timedelta(seconds=1)
+    def _diffmode(self, cn, name, versions,
+                  from_insertion_date, from_value_date, to_value_date):
+        """Turn a stream of formula versions into a stream of diffs.
+
+        When a version comes with the patch it was computed from (see
+        `_incremental_history`), only the patch is compared.
+        """
+        basets = None
+        for idx, (idate, ts, patch) in enumerate(versions):
+            if not idx:
+                # without an insertion date lower bound, the first
+                # version is also the first of all the components
+                if from_insertion_date is not None:
+                    basets = self.get(
+                        cn,
+                        name,
+                        from_value_date=from_value_date,
+                        to_value_date=to_value_date,
+                        revision_date=idate - timedelta(seconds=1)
+                    )
+                yield idate, diff_versions(basets, ts), None
+            elif patch is not None:
+                if not len(patch):
+                    yield idate, ts.iloc[:0], None
+                else:
+                    yield idate, diff_versions(basets, patch), None
+            else:
+                yield idate, diff_versions(basets, ts), None
+            basets = ts
+
+    def _pointwise(self, plan):
+        for step in plan.steps:
+            if step.op is None:
+                continue
+            if not interpreter.pointwise_operator(
+                    step.op, self.pointwise_operators):
+                return False
+            if step.op == 'series':
+                if not isinstance(step.args[0], str) or step.kwslots:
+                    return False
+                # no look at the neighbours
+                if (step.kwargs.get('prune') or
+                    isinstance(step.kwargs.get('fill'), str)):
+                    return False
+        return True
+
+    def _evaluate_history(self, cn, i, plan, name, idates, histmap,
+                          incremental):
+        """Evaluate a formula at each insertion date, possibly
+        spreading contiguous ranges of them over the worker pool, and
+        return the list of (idate, version, patch) items.
+        """
+        def evaluate(i, idates):
+            return list(
+                self._iterevaluate(i, plan, name, idates, histmap, incremental)
+            )
+
+        workers = min(self.history_workers, len(idates) // 2)
+        if workers < 2 or helper.inworker():
+            return evaluate(i, idates)
+
+        # the operators reading the base must see what the
+        # request sees
+        if not isinstance(cn, Engine):
+            i.snapshot = helper.SnapshotConnections.export(cn, workers)
+            if i.snapshot is None:
+                return evaluate(i, idates)
+
+        try:
+            helper.warm_indexes(
+                ts
+                for hist in i.histories.values()
+                for ts in hist.values()
             )
-            newh = {}
-            for idate in idates:
-                newts = diff(basets, h[idate])
-                newh[idate] = newts
-                basets = h[idate]
+            size = -(-len(idates) // workers)
+            with interpreter.Interpreter.workerpool().session(workers) as session:
+                futures = [
+                    session.submit(evaluate, i.fork(), idates[start:start + size])
+                    for start in range(0, len(idates), size)
+                ]
+            versions = []
+            for future in futures:
+                versions.extend(future.result())
+            return versions
+        finally:
+            if i.snapshot is not None:
+                i.snapshot.close()
+                i.snapshot = None
+
+    def _iterevaluate(self, i, plan, name, idates, histmap, incremental):
+        if incremental:
+            yield from self._incremental_history(
+                i, plan, name, idates, histmap
+            )
+            return
 
-            h = newh
+        for idate in idates:
+            yield idate, i.evaluate(plan, idate, name), None
 
-        return h
+    def _incremental_history(self, i, plan, name, idates, histmap):
+        """Compute a pointwise formula history: for each insertion date,
+        only the value dates touched by the new versions of the
+        components are evaluated and patched into the previous
+        version.
+
+        It yields (idate, version, patch) items, the patch being None
+        for the versions evaluated in full.
+        """
+        current = {}
+        previous = None
+        for idate in idates:
+            if previous is None:
+                # we may start in the middle of the history
+                current = {
+                    sname: i._find_by_nearest_idate(sname, idate)
+                    for sname in histmap
+                }
+            window = None
+            for sname, hist in histmap.items():
+                ts = hist.get(idate)
+                if ts is None:
+                    continue
+                changed = changed_dates(current.get(sname), ts)
+                window = changed if window is None else window.union(changed)
+                current[sname] = ts
+
+            if previous is None:
+                ts = i.evaluate(plan, idate, name)
+                patch = None
+            elif not len(window):
+                ts = previous.copy()
+                patch = previous.iloc[:0]
+            else:
+                i.window = window
+                try:
+                    patch = i.evaluate(plan, idate, name)
+                finally:
+                    i.window = None
+                ts = previous.drop(previous.index.intersection(window))
+                if not len(ts):
+                    ts = patch
+                elif len(patch):
+                    ts = pd.concat([ts, patch]).sort_index()
+                ts.name = name
+
+            yield idate, ts, patch
+            previous = ts
 
     @tx
     def insertion_dates(self, cn, name,
@@ -450,48 +1379,46 @@ class timeseries(basets):
                 todate=todate
             )
 
-        formula = self.formula(cn, name)
-        tree = parse(formula)
-        series = self.find_series(cn, tree)
-        allrevs = []
-        for name in series:
-            if not self.exists(cn, name):
-                if self.othersources:
-                    allrevs += self.othersources.insertion_dates(
-                        name,
-                        fromdate,
-                        todate
-                    )
-                continue
-            if self.formula(cn, name):
-                allrevs += self.insertion_dates(
-                    cn, name,
+        primaries, remotes, isites, hsites = self._idates_sources(cn, name)
+        allrevs = self._primaries_idates(cn, primaries, fromdate, todate)
+
+        if self.othersources:
+            for name in remotes:
+                allrevs += self.othersources.insertion_dates(
+                    name,
                     fromdate,
                     todate
                 )
-            else:
-                allrevs += [
-                    idate
-                    for _id, idate in self._revisions(
-                            cn, name,
-                            from_insertion_date=fromdate,
-                            to_insertion_date=todate
-                    )]
 
         # autotrophic operators
-        isites = self._custom_idates_sites(cn, tree)
-        for site in isites:
-            fname = site[0]
-            idates_func = IDATES[fname]
-            revs = idates_func(cn, self, site, fromdate, todate)
-            if revs:
-                allrevs += revs
-
-        # last resort: get the idates from a full history
-        # not great wrt performance ...
-        for site in self._custom_history_sites(cn, tree):
-            if site in isites:
-                continue  # we're already good
+        for site in isites + hsites:
+            allrevs += self._auto_idates(cn, site, fromdate, todate)
+
+        return sorted(set(allrevs))
+
+    def _auto_idates(self, cn, site, fromdate, todate):
+        """Return the insertion dates of an autotrophic operator
+        callsite (they are kept for `auto_idates_ttl` seconds, if
+        set).
+        """
+        fname = site[0]
+        idates_func = IDATES.get(fname)
+        engine = cn if isinstance(cn, Engine) else cn.engine
+        key = (
+            str(engine.url), self.namespace, serialize(site),
+            fromdate, todate,
+            # a re-registered operator must not get stale answers
+            idates_func or HISTORY[fname]
+        )
+        cached = self._auto_idates_cache.get(key)
+        if cached is not None and time() - cached[0] < self.auto_idates_ttl:
+            return cached[1]
+
+        if idates_func:
+            revs = list(idates_func(cn, self, site, fromdate, todate) or ())
+        else:
+            # last resort: get the idates from the history
+            # (cheap if it is a `lazyhistory`)
             hist = self.history(
                 cn,
                 None, # just mark that we won't work "by name" there
@@ -499,12 +1426,84 @@ class timeseries(basets):
                 todate,
                 _tree=site
             )
-            if hist:
-                allrevs += list(hist.keys())
-
-        # /auto
+            revs = list(hist.keys()) if hist else []
 
-        return sorted(set(allrevs))
+        if self.auto_idates_ttl:
+            if len(self._auto_idates_cache) >= self.auto_idates_cache_size:
+                # evict the oldest entry
+                self._auto_idates_cache.pop(
+                    next(iter(self._auto_idates_cache)), None
+                )
+            self._auto_idates_cache[key] = (time(), revs)
+        return revs
+
+    def _idates_sources(self, cn, name):
+        """Walk the formula dependency graph (visiting each formula once)
+        and return the primary series (name -> revision table), the
+        remote series and the autotrophic callsites providing their
+        own insertion dates or only a history.
+        """
+        leaves = set()
+        sites = {}
+        seen = set()
+        tovisit = [name]
+        while tovisit:
+            fname = tovisit.pop()
+            if fname in seen:
+                continue
+            seen.add(fname)
+            tree = parse(self.formula(cn, fname))
+            for sname in self.find_series(cn, tree):
+                if self.formula(cn, sname):
+                    tovisit.append(sname)
+                else:
+                    leaves.add(sname)
+            for site in self._custom_idates_sites(cn, tree):
+                sites[serialize(site)] = (site, True)
+            for site in self._custom_history_sites(cn, tree):
+                sites.setdefault(serialize(site), (site, False))
+
+        primaries = {}
+        if leaves:
+            primaries = dict(
+                cn.execute(
+                    f'select seriesname, tablename '
+                    f'from "{self.namespace}".registry '
+                    f'where seriesname in %(names)s',
+                    names=tuple(leaves)
+                ).fetchall()
+            )
+        remotes = sorted(leaves - set(primaries))
+        isites = [site for site, idates in sites.values() if idates]
+        hsites = [site for site, idates in sites.values() if not idates]
+        return primaries, remotes, isites, hsites
+
+    def _primaries_idates(self, cn, primaries, fromdate, todate):
+        "the insertion dates of a bunch of primary series, in one query"
+        if not primaries:
+            return []
+
+        self._guard_query_dates(fromdate, todate)
+        filters = []
+        if fromdate:
+            filters.append('insertion_date >= %(fromdate)s')
+        if todate:
+            filters.append('insertion_date <= %(todate)s')
+        where = ''
+        if filters:
+            where = 'where ' + ' and '.join(filters)
+
+        sql = ' union '.join(
+            f'select insertion_date '
+            f'from "{self.namespace}.revision"."{table}" {where}'
+            for table in sorted(set(primaries.values()))
+        )
+        return [
+            pd.Timestamp(idate).astimezone('UTC')
+            for idate, in cn.execute(
+                sql, fromdate=fromdate, todate=todate
+            ).fetchall()
+        ]
 
     @tx
     def staircase(self, cn, name, delta,
@@ -512,10 +1511,7 @@ class timeseries(basets):
                   to_value_date=None):
         formula = self.formula(cn, name)
         if formula:
-            if interpreter.has_compatible_operators(
-                    cn, self,
-                    parse(formula),
-                    self.fast_staircase_operators):
+            if self._fast_staircase(cn, formula):
                 # go fast
                 return self.get(
                     cn, name,
@@ -535,6 +1531,96 @@ class timeseries(basets):
             to_value_date
         )
 
+    @tx
+    def staircases(self, cn, name, deltas,
+                   from_value_date=None,
+                   to_value_date=None):
+        """Compute the staircases of a series for several deltas and
+        return them as a dataframe with a column per delta.
+
+        The revisions are read once for all the deltas: those of the
+        series itself, or of the formula leaves when its staircase
+        can take the fast path.
+        """
+        deltas = list(deltas)
+        if not deltas:
+            raise ValueError('staircases needs at least one delta')
+
+        if not self.exists(cn, name):
+            return
+
+        getargs = {
+            'from_value_date': from_value_date,
+            'to_value_date': to_value_date
+        }
+        formula = self.formula(cn, name)
+        if formula and self._fast_staircase(cn, formula):
+            leaves = {}
+            primaries = self._idates_sources(cn, name)[0]
+            for leaf in primaries:
+                for delta, ts in self._staircases(
+                        cn, leaf, deltas, **getargs).items():
+                    leaves.setdefault(delta, {})[leaf] = ts
+            stairs = {
+                delta: self.get(
+                    cn, name, **getargs,
+                    __interpreter__=interpreter.FastStaircaseInterpreter(
+                        cn, self, dict(getargs), delta,
+                        staircases=leaves.get(delta)
+                    )
+                )
+                for delta in deltas
+            }
+        else:
+            stairs = self._staircases(cn, name, deltas, **getargs)
+
+        return pd.concat(
+            [stairs[delta] for delta in deltas],
+            axis=1,
+            keys=deltas
+        ).sort_index()
+
+    def _staircases(self, cn, name, deltas,
+                    from_value_date=None,
+                    to_value_date=None):
+        "the staircases of a series, from its history"
+        meta = self.metadata(cn, name)
+        base = self.get(
+            cn, name,
+            from_value_date=from_value_date,
+            to_value_date=to_value_date,
+            _keep_nans=True
+        )
+        if base is None or not len(base):
+            return {
+                delta: empty_series(meta['tzaware'], name=name)
+                for delta in deltas
+            }
+
+        maxdate = base.index.max()
+        hist = self.history(
+            cn, name,
+            from_value_date=from_value_date,
+            to_value_date=to_value_date,
+            to_insertion_date=maxdate - min(deltas),
+            _keep_nans=True
+        ) or {}
+        return history_staircases(
+            hist, deltas, maxdate, meta['tzaware'], name
+        )
+
+    def _fast_staircase(self, cn, formula):
+        """Can the staircase of a formula take the fast path ?
+
+        All the operators of its expanded tree must commute with the
+        staircase transformation (clip only when it replaces its out of
+        bounds values).
+        """
+        return interpreter.staircase_tree(
+            self._expanded(cn, formula),
+            self.fast_staircase_operators
+        )
+
     @tx
     def metadata(self, cn, name):
         """Return metadata dict of timeserie."""
@@ -571,11 +1657,19 @@ class timeseries(basets):
 
     @tx
     def rename(self, cn, oldname, newname):
-        # read all formulas and parse them ...
-        formulas = cn.execute(
-            f'select name, text from "{self.namespace}".formula'
-        ).fetchall()
-        errors = []
+        ns = self.namespace
+        errors = [
+            fname for fname, in cn.execute(
+                f'select name from "{ns}".formula_dependency '
+                "where kind = 'series' and ref = %(ref)s "
+                'order by id',
+                ref=newname
+            ).fetchall()
+        ]
+        if errors:
+            raise ValueError(
+                f'new name is already referenced by `{",".join(errors)}`'
+            )
 
         def edit(tree, oldname, newname):
             newtree = []
@@ -594,41 +1688,40 @@ class timeseries(basets):
                 series = False
             return newtree
 
-        for fname, text in formulas:
-            tree = parse(text)
-            series = self.find_series(
-                cn,
-                tree
-            )
-            if newname in series:
-                errors.append(fname)
-            if oldname not in series or errors:
-                continue
+        self._materialized_stale(cn, oldname)
 
-            newtree = edit(tree, oldname, newname)
-            newtext = serialize(newtree)
-            sql = (f'update "{self.namespace}".formula '
+        # the formulas referencing the old name
+        formulas = cn.execute(
+            'select f.name, f.text '
+            f'from "{ns}".formula as f '
+            f'join "{ns}".formula_dependency as dep on dep.name = f.name '
+            "where dep.kind = 'series' and dep.ref = %(ref)s",
+            ref=oldname
+        ).fetchall()
+        for fname, text in formulas:
+            newtree = edit(parse(text), oldname, newname)
+            sql = (f'update "{ns}".formula '
                    'set text = %(text)s '
                    'where name = %(name)s')
             cn.execute(
                 sql,
-                text=newtext,
+                text=serialize(newtree),
                 name=fname
             )
-
-        if errors:
-            raise ValueError(
-                f'new name is already referenced by `{",".join(errors)}`'
-            )
+            self._register_dependencies(cn, fname, newtree)
+        if formulas:
+            self._formula_changed(cn)
 
         if self.type(cn, oldname) == 'formula':
+            # (the dependency index follows)
             cn.execute(
-                f'update "{self.namespace}".formula '
+                f'update "{ns}".formula '
                 'set name = %(newname)s '
                 'where name = %(oldname)s',
                 oldname=oldname,
                 newname=newname
             )
+            self._formula_changed(cn)
         else:
             super().rename(cn, oldname, newname)
 